@@ -0,0 +1,22 @@
+#!/usr/bin/python
+import sys
+import os
+import argparse
+import util
+
+def get_args():
+  parser = argparse.ArgumentParser(description="Compile JSON-lines activity dumps into binary catalogs that ActivityCollection memory-maps")
+  parser.add_argument("paths", nargs="+", help="JSON-lines files, e.g. restaurants.json thrill.json")
+  parser.add_argument("-o", "--outdir", help="directory for the .catalog files (default: next to each input)")
+  return parser.parse_args()
+
+def main():
+  args = get_args()
+  for path in args.paths:
+    name = os.path.splitext(os.path.basename(path))[0] + ".catalog"
+    catalog_path = os.path.join(args.outdir or os.path.dirname(path), name)
+    num_rows = util.build_catalog(path, catalog_path)
+    print "%s: %d activities -> %s" % (path, num_rows, catalog_path)
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,11 @@ Optionally run as grader.py [basic|all] to run a subset of tests
 """
 
 import random
+import itertools
+import os
+import tempfile
+import json
+import time
 
 import graderUtil
 import util
@@ -248,8 +253,9 @@ def verify_schedule(bulletin, profile, schedule, checkUnits = True):
 
     return goodSchedule
 
-# Load all courses.
-bulletin = util.CourseBulletin('courses.json')
+# Load all courses. Without the bulletin the course scheduling parts fail on
+# their own instead of stopping the day planner parts below from running.
+bulletin = util.CourseBulletin('courses.json') if hasattr(util, 'CourseBulletin') else None
 
 ############################################################
 # Problem 3a: Quarter specification
@@ -354,4 +360,816 @@ grader.addManualPart('3c', 2, description="Your own schedule")
 grader.addManualPart('4a', 2, extraCredit=True, description="Worst-case treewidth")
 grader.addManualPart('4b', 6, extraCredit=True, description="Efficient algorithm")
 
+############################################################
+# Day planner: util.CSP storage and constraints, the solvers and the activity
+# catalogs, checked against plain definitions on small instances
+
+def get_all_weights(csp):
+    """
+    Returns the weight of every complete assignment of |csp|, enumerated
+    without any search, as a list of (weight, assignment).
+    """
+    result = []
+    for values in itertools.product(*[csp.values[var] for var in csp.variables]):
+        assignment = dict(zip(csp.variables, values))
+        result.append((csp.get_assignment_weight(assignment), assignment))
+    return result
+
+def create_random_csp(seed, domains, numUnary = 0, numBinary = 0, numTernary = 0, **kwargs):
+    """
+    A weighted CSP over the variables 0 .. len(|domains|) - 1 with random
+    factor tables: a unary factor on each of the first |numUnary| variables,
+    then |numBinary| binary and |numTernary| ternary factors over random
+    variables. Some weights are 0, so some assignments are infeasible.
+    |kwargs| go to util.CSP.
+    """
+    r = random.Random(seed)
+    csp = util.CSP(**kwargs)
+    for var, domain in enumerate(domains):
+        csp.add_variable(var, domain)
+    for var in range(numUnary):
+        table = dict((x, r.choice([0, 0.5, 1, 2, 3])) for x in domains[var])
+        csp.add_unary_factor(var, lambda x, table = table: table[x])
+    for _ in range(numBinary):
+        a, b = r.sample(range(len(domains)), 2)
+        table = dict(((x, y), r.choice([0, 0.5, 1, 2])) for x in domains[a] for y in domains[b])
+        csp.add_binary_factor(a, b, lambda x, y, table = table: table[(x, y)])
+    for _ in range(numTernary):
+        a, b, c = r.sample(range(len(domains)), 3)
+        table = dict(((x, y, z), r.choice([0, 1, 1, 3])) for x in domains[a] for y in domains[b] for z in domains[c])
+        csp.add_ternary_factor(a, b, c, lambda x, y, z, table = table: table[(x, y, z)])
+    return csp
+
+def get_factor_reads(csp):
+    """
+    Returns every unary, binary and ternary weight of |csp|, read through
+    every ordering of the variables of each factor.
+    """
+    reads = []
+    for var in csp.variables:
+        reads.append([csp.get_unary_weight(var, val) for val in csp.values[var]])
+        for var2 in sorted(csp.binaryFactors[var]):
+            reads.append([csp.get_binary_weight(var, var2, val, val2)
+                for val in csp.values[var] for val2 in csp.values[var2]])
+        for var2 in sorted(csp.ternaryFactors[var]):
+            for var3 in sorted(csp.ternaryFactors[var][var2]):
+                reads.append([csp.get_ternary_weight(var, var2, var3, val, val2, val3)
+                    for val in csp.values[var] for val2 in csp.values[var2] for val3 in csp.values[var3]])
+    return reads
+
+def get_search_results(csp, **kwargs):
+    """
+    Runs BacktrackingSearch on |csp| until it has found every assignment,
+    |kwargs| go to solve(). Returns the weight and the sorted items of each
+    assignment found, sorted, and the optimal weight.
+    """
+    solver = submission.BacktrackingSearch()
+    solver.solve(csp, max_num_assignments = 1000000, **kwargs)
+    return (sorted((weight, sorted(assignment.items())) for weight, assignment in zip(solver.assignmentWeights, solver.allAssignments)),
+        solver.optimalWeight)
+
+def test_csp_1():
+    for seed in range(4):
+        csps = []
+        for kwargs in [{}, {'dense': True}]:
+            csp = create_random_csp(seed, [range(3), range(2), range(3), range(4), range(2), range(3)],
+                numUnary = 6, numBinary = 5, numTernary = 3, **kwargs)
+            # merged with the random one
+            csp.add_unary_factor(0, lambda x: x + 1)
+            csps.append(csp)
+        table, dense = csps
+        grader.requireIsEqual(get_factor_reads(table), get_factor_reads(dense))
+        grader.requireIsEqual(get_all_weights(table), get_all_weights(dense))
+        for mcv in [False, True]:
+            for ac3 in [False, True]:
+                grader.requireIsEqual(get_search_results(table, mcv = mcv, ac3 = ac3),
+                    get_search_results(dense, mcv = mcv, ac3 = ac3))
+
+grader.addBasicPart('csp-1-basic', test_csp_1, 1, maxSeconds=20, description="Dense factor tables give the weights of the dict ones")
+
+def test_csp_2():
+    for seed in range(4):
+        csps = []
+        for kwargs in [{}, {'lazy': True}, {'lazy': True, 'cache_size': 5}]:
+            csp = create_random_csp(seed, [range(3), range(2), range(3), range(4), range(2), range(3)],
+                numUnary = 6, numBinary = 5, numTernary = 3, **kwargs)
+            csp.add_unary_factor(0, lambda x: x + 1)
+            csps.append(csp)
+        table = csps[0]
+        for lazy in csps[1:]:
+            grader.requireIsEqual(get_factor_reads(table), get_factor_reads(lazy))
+            grader.requireIsEqual(get_all_weights(table), get_all_weights(lazy))
+            for mcv in [False, True]:
+                for ac3 in [False, True]:
+                    grader.requireIsEqual(get_search_results(table, mcv = mcv, ac3 = ac3),
+                        get_search_results(lazy, mcv = mcv, ac3 = ac3))
+
+    # factor functions only run on a miss, once per entry while it is cached
+    calls = []
+    def factor(x, y):
+        calls.append((x, y))
+        return x + y
+    csp = util.CSP(lazy = True, cache_size = 2)
+    csp.add_variable('A', range(3))
+    csp.add_variable('B', range(3))
+    csp.add_binary_factor('A', 'B', factor)
+    grader.requireIsEqual((0, 0), csp.get_cache_stats())
+    grader.requireIsEqual([], calls)
+    grader.requireIsEqual(3, csp.get_binary_weight('A', 'B', 1, 2))
+    grader.requireIsEqual(3, csp.get_binary_weight('B', 'A', 2, 1))
+    grader.requireIsEqual((1, 1), csp.get_cache_stats())
+    grader.requireIsEqual([(1, 2)], calls)
+    # entries are evicted least recently used first: reading (0, 0) then
+    # (1, 2) again leaves (1, 2) as the most recent, so (2, 2) evicts (0, 0)
+    csp.get_binary_weight('A', 'B', 0, 0)
+    csp.get_binary_weight('A', 'B', 1, 2)
+    csp.get_binary_weight('A', 'B', 2, 2)
+    grader.requireIsEqual((2, 3), csp.get_cache_stats())
+    csp.get_binary_weight('A', 'B', 1, 2)
+    grader.requireIsEqual((3, 3), csp.get_cache_stats())
+    csp.get_binary_weight('A', 'B', 0, 0)
+    grader.requireIsEqual((3, 4), csp.get_cache_stats())
+    grader.requireIsEqual([(1, 2), (0, 0), (2, 2), (0, 0)], calls)
+    # a factor added later over the same variables, in the other order, is
+    # multiplied in even for the entries already cached
+    csp.add_binary_factor('B', 'A', lambda y, x: 10 if y == 2 else 1)
+    grader.requireIsEqual(30, csp.get_binary_weight('A', 'B', 1, 2))
+    grader.requireIsEqual(0, csp.get_binary_weight('A', 'B', 0, 0))
+    grader.requireIsEqual((0, 0), util.CSP().get_cache_stats())
+
+grader.addBasicPart('csp-2-basic', test_csp_2, 1, maxSeconds=20, description="Lazy factors match the dict ones and are cached least recently used")
+
+def get_supported_values(variables, domains, feasible):
+    """
+    Returns var -> set of the values of |var| used by some assignment of
+    |variables| from |domains| for which |feasible(values)| holds, the
+    values being in the order of |variables|.
+    """
+    supported = dict((var, set()) for var in variables)
+    for values in itertools.product(*[domains[var] for var in variables]):
+        if feasible(values):
+            for var, val in zip(variables, values):
+                supported[var].add(val)
+    return supported
+
+def test_csp_3():
+    r = random.Random(0)
+    variables = [0, 1, 2, 3]
+    constraint = util.AllDifferentConstraint(variables)
+    for _ in range(200):
+        # get_weight() against the definition, on a random partial assignment
+        assignment = dict((var, r.choice(range(4))) for var in r.sample(variables + [4], 2))
+        var = r.choice([v for v in variables if v not in assignment])
+        val = r.choice(range(4))
+        used = [assignment[other] for other in variables if other in assignment]
+        grader.requireIsEqual(0.0 if val in used else 1.0, constraint.get_weight(assignment, var, val))
+        # prune() only drops values no all-different assignment uses
+        domains = dict((var, sorted(r.sample(range(4), r.choice([1, 1, 2, 3])))) for var in variables)
+        supported = get_supported_values(variables, domains, lambda values: len(set(values)) == len(values))
+        pruned = dict((var, list(domain)) for var, domain in domains.items())
+        changed = constraint.prune(pruned)
+        grader.requireIsEqual(sorted(var for var in variables if pruned[var] != domains[var]), sorted(changed))
+        for var in variables:
+            grader.requireIsTrue(set(pruned[var]) <= set(domains[var]))
+            grader.requireIsTrue(supported[var] <= set(pruned[var]))
+            # the value of a variable down to one is gone from the others
+            for other in variables:
+                if other != var and len(domains[other]) == 1:
+                    grader.requireIsTrue(domains[other][0] not in pruned[var])
+
+    # the constraint solves like a binary != factor between every pair
+    for seed in range(4):
+        for kwargs in [{}, {'dense': True}, {'lazy': True}]:
+            csps = []
+            for native in [False, True]:
+                csp = create_random_csp(seed, [range(3)] * 5, numUnary = 5, numBinary = 2, numTernary = 1, **kwargs)
+                if native:
+                    csp.add_all_different([0, 2, 3, 4])
+                else:
+                    for a, b in itertools.combinations([0, 2, 3, 4], 2):
+                        csp.add_binary_factor(a, b, lambda x, y: x != y)
+                csps.append(csp)
+            grader.requireIsEqual(get_all_weights(csps[0]), get_all_weights(csps[1]))
+            for mcv in [False, True]:
+                for ac3 in [False, True]:
+                    grader.requireIsEqual(get_search_results(csps[0], mcv = mcv, ac3 = ac3),
+                        get_search_results(csps[1], mcv = mcv, ac3 = ac3))
+
+grader.addBasicPart('csp-3-basic', test_csp_3, 1, maxSeconds=20, description="AllDifferentConstraint against pairwise != factors")
+
+def get_filtered_results(csp, feasible):
+    """
+    get_search_results() computed by enumeration: the assignments of |csp|
+    with a nonzero weight for which |feasible(assignment)| holds.
+    """
+    found = [(weight, sorted(assignment.items())) for weight, assignment in get_all_weights(csp)
+        if weight > 0 and feasible(assignment)]
+    return (sorted(found), max([weight for weight, items in found] + [0]))
+
+def test_csp_4():
+    r = random.Random(0)
+    variables = [0, 1, 2, 3]
+    domains = dict((var, range(4)) for var in variables)
+    for _ in range(100):
+        costs = dict((var, dict((val, r.choice([0, 1, 2, 3, 5])) for val in range(4))) for var in variables)
+        maxSum = r.choice([2, 4, 6, 9])
+        constraint = util.SumConstraint(variables, dict((var, costs[var].get) for var in variables), maxSum, domains)
+        def fits(values):
+            return sum(costs[var][val] for var, val in zip(variables, values)) <= maxSum
+        # get_weight() is 1 iff some completion of |assignment| fits
+        assignment = dict((var, r.choice(range(4))) for var in r.sample(variables, r.choice([0, 1, 2])))
+        var = r.choice([v for v in variables if v not in assignment])
+        for val in range(4):
+            extended = dict(assignment)
+            extended[var] = val
+            choices = [[extended[v]] if v in extended else domains[v] for v in variables]
+            feasible = any(fits(values) for values in itertools.product(*choices))
+            grader.requireIsEqual(1.0 if feasible else 0.0, constraint.get_weight(assignment, var, val))
+        # prune() leaves exactly the values some fitting assignment uses
+        pruneDomains = dict((var, sorted(r.sample(range(4), r.choice([1, 2, 3, 4])))) for var in variables)
+        supported = get_supported_values(variables, pruneDomains, fits)
+        if not any(supported.values()): continue
+        pruned = dict((var, list(domain)) for var, domain in pruneDomains.items())
+        changed = constraint.prune(pruned)
+        grader.requireIsEqual(sorted(var for var in variables if pruned[var] != pruneDomains[var]), sorted(changed))
+        for var in variables:
+            grader.requireIsEqual(sorted(supported[var]), pruned[var])
+
+    # a derived variable in the sum counts with its computed value; the sum
+    # may be added before or after the variable is made derived
+    for seed in range(4):
+        for kwargs in [{}, {'dense': True}, {'lazy': True}]:
+            for derivedFirst in [True, False]:
+                csp = create_random_csp(seed, [range(3)] * 5, numUnary = 5, numBinary = 3, numTernary = 1, **kwargs)
+                base = create_random_csp(seed, [range(3)] * 5, numUnary = 5, numBinary = 3, numTernary = 1, **kwargs)
+                for c in [csp, base]:
+                    c.add_variable('d', range(5))
+                if derivedFirst: csp.add_functional_constraint('d', [0, 1], lambda x, y: x + y)
+                csp.add_sum_constraint([2, 3, 'd'], {2: lambda x: x, 3: lambda x: 2 * x, 'd': lambda x: x}, 4)
+                if not derivedFirst: csp.add_functional_constraint('d', [0, 1], lambda x, y: x + y)
+                base.add_functional_constraint('d', [0, 1], lambda x, y: x + y)
+                expected = get_filtered_results(base, lambda a: a[2] + 2 * a[3] + a['d'] <= 4)
+                grader.requireIsTrue(len(expected[0]) > 0)
+                for mcv in [False, True]:
+                    for ac3 in [False, True]:
+                        grader.requireIsEqual(expected, get_search_results(csp, mcv = mcv, ac3 = ac3))
+
+grader.addBasicPart('csp-4-basic', test_csp_4, 1, maxSeconds=20, description="SumConstraint checks and prunes against the cheapest completion")
+
+def test_csp_5():
+    r = random.Random(0)
+    variables = [0, 1, 2, 3]
+    domains = dict((var, range(4)) for var in variables)
+    predicate = lambda x: x < 2
+    for _ in range(100):
+        minCount = r.choice([0, 1, 2, 3])
+        maxCount = r.choice([minCount, minCount + 1, 4])
+        constraint = util.CountConstraint(variables, predicate, minCount, maxCount, domains)
+        def fits(values):
+            return minCount <= len([val for val in values if predicate(val)]) <= maxCount
+        # get_weight() is 1 iff some completion of |assignment| fits
+        assignment = dict((var, r.choice(range(4))) for var in r.sample(variables, r.choice([0, 1, 2, 3])))
+        var = r.choice([v for v in variables if v not in assignment])
+        for val in range(4):
+            extended = dict(assignment)
+            extended[var] = val
+            choices = [[extended[v]] if v in extended else domains[v] for v in variables]
+            feasible = any(fits(values) for values in itertools.product(*choices))
+            grader.requireIsEqual(1.0 if feasible else 0.0, constraint.get_weight(assignment, var, val))
+        # prune() leaves exactly the values some fitting assignment uses,
+        # and empties a domain when there is none
+        pruneDomains = dict((var, sorted(r.sample(range(4), r.choice([1, 2, 3])))) for var in variables)
+        supported = get_supported_values(variables, pruneDomains, fits)
+        pruned = dict((var, list(domain)) for var, domain in pruneDomains.items())
+        changed = constraint.prune(pruned)
+        grader.requireIsEqual(sorted(var for var in variables if pruned[var] != pruneDomains[var]), sorted(changed))
+        if any(supported.values()):
+            for var in variables:
+                grader.requireIsEqual(sorted(supported[var]), pruned[var])
+        else:
+            grader.requireIsTrue(any(len(pruned[var]) == 0 for var in variables))
+
+    for seed in range(4):
+        for kwargs in [{}, {'dense': True}, {'lazy': True}]:
+            for minCount, maxCount in [(0, 1), (2, 2), (1, None)]:
+                csp = create_random_csp(seed, [range(3)] * 5, numUnary = 5, numBinary = 3, numTernary = 1, **kwargs)
+                csp.add_count_constraint([0, 2, 3, 4], lambda x: x == 0, minCount, maxCount)
+                upper = 4 if maxCount is None else maxCount
+                expected = get_filtered_results(create_random_csp(seed, [range(3)] * 5, numUnary = 5, numBinary = 3,
+                    numTernary = 1, **kwargs), lambda a: minCount <= [a[var] for var in [0, 2, 3, 4]].count(0) <= upper)
+                for mcv in [False, True]:
+                    for ac3 in [False, True]:
+                        grader.requireIsEqual(expected, get_search_results(csp, mcv = mcv, ac3 = ac3))
+
+grader.addBasicPart('csp-5-basic', test_csp_5, 1, maxSeconds=20, description="CountConstraint checks and prunes against the number of matches left")
+
+def write_activity_lines(infos):
+    """
+    Writes |infos| as a JSON-lines activity dump to a temporary file and
+    returns its path.
+    """
+    handle, path = tempfile.mkstemp(suffix = '.json')
+    with os.fdopen(handle, 'w') as f:
+        for info in infos:
+            f.write(json.dumps(info) + '\n')
+    return path
+
+def get_activity_info(i, latitude = 37.4):
+    return {'name': 'activity %d' % i, 'coordinates': {'latitude': latitude, 'longitude': -122.1 - i * 0.001},
+        'rating': 1 + i % 5, 'review_count': i * 7, 'time_spent_minutes': 30 + 10 * (i % 4), 'price': '$' * (1 + i % 4)}
+
+def test_activity_1():
+    profile = util.Profile('profile3a.txt')
+    limit = util.LIMIT_NUM_ACTIVITIES_PER_FILE
+    paths = []
+    try:
+        # a sample of at most |limit| valid activities, numbered in file order
+        for numLines in [limit // 2, limit, limit + 50]:
+            path = write_activity_lines([get_activity_info(i) for i in range(numLines)])
+            paths.append(path)
+            activities = util.ActivityCollection(profile, {'thrill': path}).activities['thrill']
+            grader.requireIsEqual(min(numLines, limit), len(activities))
+            lines = [int(activities[i].name.split()[1]) for i in sorted(activities)]
+            grader.requireIsEqual(range(len(activities)), sorted(activities))
+            grader.requireIsEqual(sorted(lines), lines)
+            grader.requireIsEqual(len(lines), len(set(lines)))
+        path = write_activity_lines([get_activity_info(i, None if i == 2 else 37.4) for i in range(5)])
+        paths.append(path)
+        names = [a.name for a in util.ActivityCollection(profile, {'thrill': path}).activities['thrill'].values()]
+        grader.requireIsEqual(['activity 0', 'activity 1', 'activity 3', 'activity 4'], sorted(names))
+
+        # with a sample of 3 of 6 lines, each of the 20 subsets comes up
+        # with probability 1/20
+        util.LIMIT_NUM_ACTIVITIES_PER_FILE = 3
+        path = write_activity_lines([get_activity_info(i) for i in range(6)])
+        paths.append(path)
+        random.seed(0)
+        numTrials = 4000
+        counts = collections.Counter()
+        for _ in range(numTrials):
+            activities = util.ActivityCollection(profile, {'thrill': path}).activities['thrill']
+            counts[tuple(sorted(a.name for a in activities.values()))] += 1
+        grader.requireIsEqual(20, len(counts))
+        for subset, count in counts.items():
+            grader.requireIsEqual(1.0 / 20, float(count) / numTrials, 0.02)
+    finally:
+        util.LIMIT_NUM_ACTIVITIES_PER_FILE = limit
+        for path in paths:
+            os.remove(path)
+
+grader.addBasicPart('activity-1-basic', test_activity_1, 1, maxSeconds=30, description="Reservoir sampling keeps a uniform sample of the catalog lines")
+
+def read_activities(path, is_restaurant, firstId = 0):
+    activities = []
+    with open(path, 'r') as f:
+        for line in f:
+            info = json.loads(line)
+            if not util.ActivityCollection.is_valid_activity(info): continue
+            activities.append(util.Activity(firstId + len(activities), info, is_restaurant))
+    return activities
+
+def test_activity_2():
+    activities = read_activities('../activities_short.json', False)
+    activities += read_activities('../restaurants_short.json', True, len(activities))
+    fields = ['unique_id', 'name'] + [name for name, dtype in util.ActivityTable.columns]
+    records = [tuple(getattr(a, name) for name in fields) for a in activities]
+    for table in [util.ActivityTable(activities), util.ActivityTable.from_records(records)]:
+        grader.requireIsEqual(len(activities), len(table))
+        for a in activities:
+            row = table[a.unique_id]
+            grader.requireIsEqual([getattr(a, name) for name in fields], [getattr(row, name) for name in fields])
+            grader.requireIsEqual(str(a), str(row))
+            grader.requireIsEqual(a.short_str(), row.short_str())
+            for index in ['rating', 'coordinates', 'review_count', 'is_food']:
+                grader.requireIsEqual(a[index], row[index])
+            grader.requireIsTrue(row is table[a.unique_id])
+            try:
+                row.rating = 0
+                grader.fail("ActivityRow accepted an assignment")
+            except AttributeError:
+                pass
+            grader.requireIsEqual(a.rating, row.rating)
+        unique_ids = [a.unique_id for a in reversed(activities)][::2]
+        for name, dtype in util.ActivityTable.columns:
+            grader.requireIsEqual([getattr(a, name) for a in activities], table.get_column(name).tolist())
+            grader.requireIsEqual([getattr(activities[i], name) for i in unique_ids], table.get_column(name, unique_ids).tolist())
+    grader.requireIsEqual(0, len(util.ActivityTable([])))
+
+grader.addBasicPart('activity-2-basic', test_activity_2, 1, maxSeconds=5, description="ActivityTable rows read the same as the Activity objects they were built from")
+
+def test_activity_3():
+    profile = util.Profile('profile3a.txt')
+    handle, catalogPath = tempfile.mkstemp(suffix = '.catalog')
+    os.close(handle)
+    try:
+        for path, genre in [('../activities_short.json', 'thrill'), ('../restaurants_short.json', 'food')]:
+            activities = read_activities(path, False)
+            yelpIds = []
+            with open(path, 'r') as f:
+                for line in f:
+                    info = json.loads(line)
+                    if util.ActivityCollection.is_valid_activity(info): yelpIds.append(info.get('id', ''))
+            grader.requireIsEqual(len(activities), util.build_catalog(path, catalogPath))
+            catalog = util.Catalog(catalogPath)
+            grader.requireIsEqual(len(activities), len(catalog))
+            grader.requireIsEqual([a.name for a in activities], [catalog.get_name(row) for row in range(len(catalog))])
+            grader.requireIsEqual(yelpIds, [catalog.get_yelp_id(row) for row in range(len(catalog))])
+            for name in ['latitude', 'longitude', 'rating', 'review_count', 'cost', 'duration']:
+                grader.requireIsEqual([getattr(a, name) for a in activities], catalog.records[name].tolist())
+            del catalog
+
+            # every line fits in the sample, so both loaders see the same rows
+            fromJson = util.ActivityCollection(profile, {genre: path})
+            fromCatalog = util.ActivityCollection(profile, {genre: catalogPath})
+            grader.requireIsEqual(sorted(fromJson.activities[genre]), sorted(fromCatalog.activities[genre]))
+            for unique_id, row in fromJson.activities[genre].items():
+                grader.requireIsEqual(fromJson.table.values[row.row], fromCatalog.table.values[fromCatalog.activities[genre][unique_id].row])
+    finally:
+        os.remove(catalogPath)
+    try:
+        util.Catalog('../activities_short.json')
+        grader.fail("Catalog opened a JSON file")
+    except Exception:
+        pass
+
+grader.addBasicPart('activity-3-basic', test_activity_3, 1, maxSeconds=5, description="build_catalog and Catalog round-trip the fields ActivityCollection uses")
+
+def create_constrained_csp(seed, constrained = True, **kwargs):
+    """
+    create_random_csp() over six variables and 'd' = x + y of the first two,
+    with an all-different, a sum (over 'd') and a count constraint unless
+    |constrained| is False. is_constrained_feasible() checks the constraints.
+    """
+    csp = create_random_csp(seed, [range(3)] * 6, numUnary = 6, numBinary = 2, numTernary = 1, **kwargs)
+    csp.add_variable('d', range(5))
+    csp.add_functional_constraint('d', [0, 1], lambda x, y: x + y)
+    if constrained:
+        csp.add_all_different([2, 3])
+        csp.add_sum_constraint([3, 5, 'd'], {3: lambda x: x, 5: lambda x: 2 * x, 'd': lambda x: x}, 4)
+        csp.add_count_constraint([0, 4, 5], lambda x: x == 0, 1)
+    return csp
+
+def is_constrained_feasible(a):
+    return (a[2] != a[3] and a[3] + 2 * a[5] + a['d'] <= 4 and
+        [a[0], a[4], a[5]].count(0) >= 1)
+
+def test_bt_1():
+    domains = submission.TrailDomains({0: [1, 2], 1: [3]})
+    start = domains.mark()
+    domains[0] = [1]
+    middle = domains.mark()
+    domains[1] = []
+    domains[0] = []
+    grader.requireIsEqual({0: [], 1: []}, dict(domains))
+    domains.undo(middle)
+    grader.requireIsEqual({0: [1], 1: [3]}, dict(domains))
+    domains.undo(start)
+    grader.requireIsEqual({0: [1, 2], 1: [3]}, dict(domains))
+    grader.requireIsEqual([], domains.trail)
+
+    # the search finds every feasible assignment and leaves the domains as
+    # they were
+    for seed in range(4):
+        expected = get_filtered_results(create_constrained_csp(seed, False), is_constrained_feasible)
+        grader.requireIsTrue(len(expected[0]) > 0)
+        for kwargs in [{}, {'dense': True}]:
+            csp = create_constrained_csp(seed, **kwargs)
+            for mcv in [False, True]:
+                for ac3 in [False, True]:
+                    grader.requireIsEqual(expected, get_search_results(csp, mcv = mcv, ac3 = ac3))
+                    solver = submission.BacktrackingSearch()
+                    solver.solve(csp, mcv = mcv, ac3 = ac3, max_num_assignments = 1000000)
+                    grader.requireIsEqual(dict((var, list(csp.values[var])) for var in csp.variables), dict(solver.domains))
+                    grader.requireIsEqual([], solver.domains.trail)
+
+grader.addBasicPart('bt-1-basic', test_bt_1, 1, maxSeconds=20, description="Backtracking with the domain trail finds every feasible assignment")
+
+def create_ternary_csp():
+    """
+    The optimum (16, A = B = 1) only shows once C completes the ternary
+    factor, after A = B = 0 (9) was found: a bound that counts the ternary
+    factor once for C prunes it.
+    """
+    csp = util.CSP()
+    for var in ['A', 'B', 'C']:
+        csp.add_variable(var, [0, 1])
+    csp.add_unary_factor('A', lambda a: 3 if a == 0 else 1)
+    csp.add_unary_factor('B', lambda b: 3 if b == 0 else 1)
+    csp.add_ternary_factor('A', 'B', 'C', lambda a, b, c: 4 if a == b == 1 else 1)
+    return csp
+
+def test_bb_1():
+    for seed in range(6):
+        weights = [weight for weight, assignment in get_all_weights(create_constrained_csp(seed))]
+        best = max(weights)
+        for kwargs in [{}, {'dense': True}, {'lazy': True}]:
+            for mcv in [False, True]:
+                for ac3 in [False, True]:
+                    solver = submission.BacktrackingSearch()
+                    solver.solve(create_constrained_csp(seed, **kwargs), mcv = mcv, ac3 = ac3, branch_and_bound = True)
+                    grader.requireIsEqual(best, solver.optimalWeight)
+                    grader.requireIsEqual(len([w for w in weights if abs(w - best) < 1e-9]), solver.numOptimalAssignments)
+
+grader.addBasicPart('bb-1-basic', test_bb_1, 2, maxSeconds=20, description="Branch and bound finds the optimum of random CSPs")
+
+def test_bb_2():
+    best = max(get_all_weights(create_ternary_csp()))
+    grader.requireIsEqual(16, best[0])
+    for mcv in [False, True]:
+        solver = submission.BacktrackingSearch()
+        solver.solve(create_ternary_csp(), mcv = mcv, branch_and_bound = True)
+        grader.requireIsEqual(best[0], solver.optimalWeight)
+        grader.requireIsEqual(best[1], solver.optimalAssignment)
+
+grader.addBasicPart('bb-2-basic', test_bb_2, 1, maxSeconds=1, description="Branch and bound bounds ternary factors")
+
+class RecountingSearch(submission.BacktrackingSearch):
+    """
+    A search that checks every incremental MCV choice against a full
+    recount of the values left with a nonzero weight.
+    """
+    def get_unassigned_variable(self, assignment):
+        var = submission.BacktrackingSearch.get_unassigned_variable(self, assignment)
+        self.numChoices += 1
+        grader.requireIsEqual(self.recount_mcv(assignment), var)
+        return var
+
+    def recount_mcv(self, assignment):
+        for var in self.csp.variables:
+            if var in self.csp.derivedVars and var not in assignment and \
+                    all(input in assignment for input in self.csp.derivedVars[var].inputs):
+                return var
+        counts = [(len([val for val in self.domains[var] if self.get_delta_weight(assignment, var, val) != 0]), position, var)
+            for position, var in enumerate(self.csp.variables) if var not in assignment and var not in self.csp.derivedVars]
+        if counts: return min(counts)[2]
+        return [var for var in self.csp.variables if var not in assignment][0]
+
+def test_bt_2():
+    for seed in range(6):
+        for kwargs in [{}, {'dense': True}]:
+            for ac3 in [False, True]:
+                for options in [{'max_num_assignments': 1000000}, {'branch_and_bound': True}]:
+                    solver = RecountingSearch()
+                    solver.numChoices = 0
+                    solver.solve(create_constrained_csp(seed, **kwargs), mcv = True, ac3 = ac3, **options)
+                    grader.requireIsTrue(solver.numChoices > 0)
+
+grader.addBasicPart('bt-2-basic', test_bt_2, 1, maxSeconds=30, description="Incremental MCV picks the variable a full recount does")
+
+def test_bt_3():
+    for seed in range(6):
+        # AC-3 only drops values no feasible assignment uses
+        csp = create_constrained_csp(seed)
+        feasible = [assignment for weight, assignment in get_all_weights(create_constrained_csp(seed, False))
+            if weight > 0 and is_constrained_feasible(assignment)]
+        for var in [0, 3, 5]:
+            for val in csp.values[var]:
+                solver = submission.BacktrackingSearch()
+                solver.prepare(csp, False, True, 1, False, submission.SolveClock())
+                solver.domains[var] = [val]
+                solver.arc_consistency_check(var)
+                for other in csp.variables:
+                    used = set(assignment[other] for assignment in feasible if assignment[var] == val)
+                    grader.requireIsTrue(used <= set(solver.domains[other]))
+
+        # and the search finds the same assignments with fewer operations
+        for kwargs in [{}, {'dense': True}, {'lazy': True}]:
+            for mcv in [False, True]:
+                results = []
+                numOperations = []
+                for ac3 in [False, True]:
+                    results.append(get_search_results(create_constrained_csp(seed, **kwargs), mcv = mcv, ac3 = ac3))
+                    solver = submission.BacktrackingSearch()
+                    solver.solve(create_constrained_csp(seed, **kwargs), mcv = mcv, ac3 = ac3, max_num_assignments = 1000000)
+                    numOperations.append(solver.numOperations)
+                grader.requireIsEqual(results[0], results[1])
+                grader.requireIsTrue(numOperations[1] <= numOperations[0])
+
+grader.addBasicPart('bt-3-basic', test_bt_3, 1, maxSeconds=30, description="AC-3 with residual supports keeps every feasible value")
+
+def test_bb_4():
+    for seed in range(3):
+        for options in [{'branch_and_bound': True}, {'max_num_assignments': 100000}, {'num_best': 5}]:
+            results = []
+            for processes in [1, 2]:
+                solver = submission.BacktrackingSearch()
+                solver.solve(create_constrained_csp(seed), mcv = True, processes = processes, **options)
+                # branch and bound lists every improvement, which depends on
+                # the order the subtrees are searched in
+                assignments = [] if 'branch_and_bound' in options else solver.allAssignments
+                results.append((solver.optimalWeight, solver.numOptimalAssignments,
+                    sorted(sorted(a.items()) for a in solver.allOptimalAssignments),
+                    sorted(sorted(a.items()) for a in assignments)))
+            grader.requireIsEqual(results[0], results[1])
+
+grader.addBasicPart('bb-4-basic', test_bb_4, 1, maxSeconds=20, description="A parallel search finds what a sequential one does")
+
+def create_slot_csp(seed, **kwargs):
+    """
+    create_random_csp() over the 11 slot variables BeamSearch orders, with a
+    sum over the odd slots and an all-different over three even ones.
+    """
+    csp = create_random_csp(seed, [range(3) if var % 2 == 0 else [0, 1] for var in range(11)],
+        numUnary = 11, numBinary = 4, **kwargs)
+    csp.add_sum_constraint([1, 3, 5, 7, 9], lambda x: x, 3)
+    csp.add_all_different([2, 4, 6])
+    return csp
+
+def test_bt_4():
+    now = time.time()
+    grader.requireIsEqual(now + 10, submission.SolveClock(100, now + 10).deadline, 1)
+    clock = submission.SolveClock(5, now + 100)
+    grader.requireIsEqual(clock.start + 5, clock.deadline)
+    grader.requireIsTrue(not submission.SolveClock().expired())
+    grader.requireIsTrue(submission.SolveClock(deadline = now - 1).expired())
+
+    for seed in range(4):
+        csp = create_constrained_csp(seed)
+        # a deadline already past stops the search before any assignment
+        solver = submission.BacktrackingSearch()
+        solver.solve(csp, mcv = True, max_num_assignments = 1000000, deadline = time.time() - 1)
+        grader.requireIsTrue(solver.timedOut)
+        grader.requireIsEqual([], solver.allAssignments)
+        # a generous budget changes nothing
+        grader.requireIsEqual(get_search_results(csp, mcv = True), get_search_results(csp, mcv = True, time_budget = 1000))
+        solver = submission.BacktrackingSearch()
+        solver.solve(csp, mcv = True, max_num_assignments = 1000000, time_budget = 1000)
+        grader.requireIsTrue(not solver.timedOut)
+        # on_improvement sees each new best weight, the last is the optimum
+        for options in [{'max_num_assignments': 1000000}, {'branch_and_bound': True}]:
+            improvements = []
+            solver = submission.BacktrackingSearch()
+            solver.solve(csp, ac3 = True, on_improvement = lambda weight, elapsed, assignment:
+                improvements.append((weight, csp.get_assignment_weight(assignment))), **options)
+            grader.requireIsTrue(len(improvements) > 0)
+            grader.requireIsEqual([(weight, weight) for weight, check in improvements], improvements)
+            grader.requireIsTrue(all(a[0] < b[0] for a, b in zip(improvements, improvements[1:])))
+            grader.requireIsEqual(solver.optimalWeight, improvements[-1][0])
+
+    for seed in range(4):
+        solver = submission.BeamSearch()
+        solver.solve(create_slot_csp(seed), k = 5, deadline = time.time() - 1)
+        grader.requireIsTrue(solver.timedOut)
+        grader.requireIsEqual({}, solver.optimalAssignment)
+        improvements = []
+        budgeted = submission.BeamSearch()
+        budgeted.solve(create_slot_csp(seed), k = 5, time_budget = 1000,
+            on_improvement = lambda weight, elapsed, assignment: improvements.append(weight))
+        solver = submission.BeamSearch()
+        solver.solve(create_slot_csp(seed), k = 5)
+        grader.requireIsTrue(not budgeted.timedOut)
+        grader.requireIsEqual(solver.allAssignments, budgeted.allAssignments)
+        grader.requireIsEqual([solver.optimalWeight] if solver.optimalAssignment else [], improvements)
+
+grader.addBasicPart('bt-4-basic', test_bt_4, 1, maxSeconds=30, description="Time budgets, deadlines and on_improvement")
+
+def test_bb_3():
+    for seed in range(4):
+        csp = create_constrained_csp(seed)
+        weights = sorted([weight for weight, assignment in get_all_weights(csp) if weight > 0], reverse = True)
+        for numBest in [1, 5, 20]:
+            for ac3 in [False, True]:
+                solver = submission.BacktrackingSearch()
+                solver.solve(create_constrained_csp(seed), mcv = True, ac3 = ac3, num_best = numBest)
+                grader.requireIsEqual(weights[:numBest], solver.assignmentWeights)
+                for assignment, weight in zip(solver.allAssignments, solver.assignmentWeights):
+                    grader.requireIsEqual(weight, csp.get_assignment_weight(assignment))
+
+grader.addBasicPart('bb-3-basic', test_bb_3, 1, maxSeconds=10, description="num_best lists the best assignments best first")
+
+def test_beam_1():
+    root = submission.BeamNode(None, None, None, 1)
+    node = submission.BeamNode(root, 0, 2, 2)
+    left = submission.BeamNode(node, 10, 1, 6)
+    right = submission.BeamNode(node, 10, 0, 4)
+    grader.requireIsEqual({}, root.get_assignment())
+    grader.requireIsEqual({0: 2, 10: 1}, left.get_assignment())
+    grader.requireIsEqual({0: 2, 10: 0}, right.get_assignment())
+    grader.requireIsTrue(left.parent is right.parent)
+    # each call hands out a new dictionary
+    assignment = left.get_assignment()
+    assignment[1] = 0
+    grader.requireIsEqual({0: 2, 10: 1}, left.get_assignment())
+    grader.requireIsEqual({0: 2}, node.get_assignment())
+
+    # the final beam holds distinct complete assignments, best first, each
+    # with its own weight
+    for seed in range(8):
+        csp = create_slot_csp(seed)
+        for k in [1, 4, 30]:
+            solver = submission.BeamSearch()
+            solver.solve(csp, k = k)
+            grader.requireIsTrue(len(solver.allAssignments) <= k)
+            for assignment, weight in solver.allAssignments:
+                grader.requireIsEqual(sorted(csp.variables), sorted(assignment))
+                grader.requireIsEqual(csp.get_assignment_weight(assignment), weight)
+            weights = [weight for assignment, weight in solver.allAssignments]
+            grader.requireIsEqual(sorted(weights, reverse = True), weights)
+            grader.requireIsEqual(len(weights), len(set(tuple(sorted(a.items())) for a, w in solver.allAssignments)))
+            if weights:
+                grader.requireIsEqual(weights[0], solver.optimalWeight)
+
+grader.addBasicPart('beam-1-basic', test_beam_1, 1, maxSeconds=10, description="Beam nodes share their parents and keep the weight of their assignment")
+
+def get_sorted_beam(csp, k):
+    """
+    Beam search the plain way: every extension of the beam is copied into a
+    new dictionary and all of them are sorted, stably, by weight.
+    """
+    beam = [({}, 1)]
+    for var in [0, 10] + range(1, 10):
+        extended = []
+        for assignment, weight in beam:
+            for val in csp.values[var]:
+                deltaWeight = csp.get_delta_weight(assignment, var, val)
+                if deltaWeight > 0:
+                    newAssignment = dict(assignment)
+                    newAssignment[var] = val
+                    extended.append((newAssignment, weight * deltaWeight))
+        beam = sorted(extended, key = lambda pair: -pair[1])[:k]
+        if len(beam) == 0: break
+    return beam
+
+def test_beam_2():
+    for seed in range(8):
+        for kwargs in [{}, {'dense': True}]:
+            csp = create_slot_csp(seed, **kwargs)
+            for k in [1, 2, 4, 7, 30]:
+                solver = submission.BeamSearch()
+                solver.solve(csp, k = k)
+                grader.requireIsEqual(get_sorted_beam(csp, k), solver.allAssignments)
+    # with all weights equal, ties keep the order the extensions were made in
+    csp = util.CSP()
+    for var in range(11):
+        csp.add_variable(var, [0, 1])
+    for k in [1, 3, 10]:
+        solver = submission.BeamSearch()
+        solver.solve(csp, k = k)
+        grader.requireIsEqual(get_sorted_beam(csp, k), solver.allAssignments)
+
+grader.addBasicPart('beam-2-basic', test_beam_2, 1, maxSeconds=10, description="The heap beam keeps what sorting every extension does")
+
+def test_beam_3():
+    for seed in range(8):
+        csp = create_slot_csp(seed)
+        best = max(weight for weight, assignment in get_all_weights(csp))
+        for k in [1, 4, 30]:
+            solver = submission.BeamSearch()
+            solver.solve(csp, k = k)
+            vectorized = submission.BeamSearch()
+            vectorized.solve(create_slot_csp(seed, dense = True), k = k, vectorized = True)
+            grader.requireIsEqual(solver.allAssignments, vectorized.allAssignments)
+        # a beam wider than the number of assignments is exhaustive
+        for vectorized in [False, True]:
+            solver = submission.BeamSearch()
+            solver.solve(create_slot_csp(seed, dense = True), k = 100000, vectorized = vectorized)
+            grader.requireIsEqual(best, solver.allAssignments[0][1] if solver.allAssignments else 0)
+
+grader.addBasicPart('beam-3-basic', test_beam_3, 1, maxSeconds=30, description="The vectorized beam matches beamsearch()")
+
+def test_beam_4():
+    # a signature telling every partial assignment apart merges nothing
+    distinct = lambda signature, var, val: (signature, var, val)
+    for seed in range(8):
+        for k in [1, 4, 30]:
+            solver = submission.BeamSearch()
+            solver.solve(create_slot_csp(seed), k = k)
+            for vectorized in [False, True]:
+                beam = submission.BeamSearch()
+                beam.solve(create_slot_csp(seed, dense = True), k = k, vectorized = vectorized, state_signature = distinct)
+                grader.requireIsEqual(solver.allAssignments, beam.allAssignments)
+
+    # with only unary factors and one all-different constraint, partial
+    # assignments that used the same all-different values have the same
+    # futures, so merging them by those values keeps the search exact with
+    # a beam as wide as the number of such sets
+    def signature(signature, var, val):
+        used = signature or frozenset()
+        return used | frozenset([val]) if var in [2, 4, 6] else used
+    for seed in range(8):
+        csp = create_random_csp(seed, [range(3) if var in [2, 4, 6] else [0, 1] for var in range(11)], numUnary = 11, dense = True)
+        csp.add_all_different([2, 4, 6])
+        best = max(weight for weight, assignment in get_all_weights(csp))
+        for vectorized in [False, True]:
+            solver = submission.BeamSearch()
+            solver.solve(csp, k = 8, vectorized = vectorized, state_signature = signature)
+            grader.requireIsEqual(best, solver.allAssignments[0][1] if solver.allAssignments else 0)
+
+grader.addBasicPart('beam-4-basic', test_beam_4, 1, maxSeconds=10, description="Merging equivalent beam states keeps the optimum")
+
+def test_dp_1():
+    for profilePath in ['profile3a.txt', 'berkProfile.txt']:
+        profile = util.Profile(profilePath)
+        genreToPath = {'thrill': '../activities_short.json', 'food': '../restaurants_short.json'}
+        activities = util.ActivityCollection(profile, genreToPath).activities
+        cspConstructor = submission.SchedulingCSPConstructor(activities, profile)
+        solver = submission.BacktrackingSearch()
+        solver.solve(cspConstructor.get_basic_csp(), mcv = True, branch_and_bound = True)
+        dp = submission.ChainDPSolver()
+        dp.solve(cspConstructor)
+        grader.requireIsTrue(dp.exact)
+        grader.requireIsEqual(solver.optimalWeight, dp.optimalWeight)
+
+grader.addBasicPart('dp-1-basic', test_dp_1, 1, maxSeconds=20, description="ChainDPSolver finds the branch and bound optimum")
+
 grader.grade()
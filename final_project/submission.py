@@ -1,11 +1,40 @@
 
-import collections, util, copy, random
-import math
+import collections, util, copy, random, heapq
+import multiprocessing
+import math, time
+import numpy as np
 from math import *
 import geopy.distance
 import collections, util, copy
 time_per_mile = 2 # minutes
 
+# Wall-clock limit and progress reporting shared by the solvers. A solve is
+# cut off at |deadline| (a time.time() value) or |time_budget| seconds after it
+# starts, whichever comes first, and keeps the best assignment found so far.
+# on_improvement(weight, elapsed, assignment) is called whenever the best
+# weight improves.
+class SolveClock():
+    def __init__(self, time_budget = None, deadline = None, on_improvement = None):
+        self.start = time.time()
+        if time_budget is not None:
+            budgetDeadline = self.start + time_budget
+            deadline = budgetDeadline if deadline is None else min(deadline, budgetDeadline)
+        self.deadline = deadline
+        self.on_improvement = on_improvement
+        self.bestWeight = None
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def improve(self, weight, assignment):
+        if weight <= 0 or (self.bestWeight is not None and weight <= self.bestWeight): return
+        self.bestWeight = weight
+        if self.on_improvement is not None:
+            self.on_improvement(weight, self.elapsed(), assignment)
+
 
 class ICM():
 
@@ -56,26 +85,10 @@ class ICM():
             will be used as a multiplier on the current weight.
         """
         assert var not in assignment
-        w = 1.0
-        if self.csp.unaryFactors[var]:
-            w *= self.csp.unaryFactors[var][val]
-            #if w == 0: print "due to unary factors"
-            if w == 0: return w
-        for var2, factor in self.csp.binaryFactors[var].iteritems():
-            if var2 not in assignment: continue  # Not assigned yet
-            w *= factor[val][assignment[var2]]
-            #if w == 0: print "due to binary factor"
-            if w == 0: return w
-        for var2 in self.csp.ternaryFactors[var]:
-            # print self.csp.ternaryFactors[var], "done", var, "done", var2, "HIIIII"
-            for var3, factor in self.csp.ternaryFactors[var][var2].iteritems():
-                if var2 not in assignment or var3 not in assignment: continue  # Not assigned yet
-                w *= factor[val][assignment[var2]][assignment[var3]]
-                #if w == 0: print "due to ternary factor"
-                if w == 0: return w
-        return w
-
-    def solve(self, csp, max_iterations = 100, initial_assignment = None, gibbs_sampling = False):
+        return self.csp.get_delta_weight(assignment, var, val)
+
+    def solve(self, csp, max_iterations = 100, initial_assignment = None, gibbs_sampling = False,
+            time_budget = None, deadline = None, on_improvement = None):
         """
         Solves the given weighted CSP using heuristics as specified in the
         parameter. Note that unlike a typical unweighted CSP where the search
@@ -87,10 +100,14 @@ class ICM():
         @param mcv: When enabled, Most Constrained Variable heuristics is used.
         @param ac3: When enabled, AC-3 will be used after each assignment of an
             variable is made.
+        @param time_budget, deadline, on_improvement: see SolveClock. The
+            iterations stop when time runs out and timedOut is set.
         """
         # CSP to be solved.
         self.csp = csp
         self.gibbs_sampling = gibbs_sampling
+        self.clock = SolveClock(time_budget, deadline, on_improvement)
+        self.timedOut = False
        
         # Reset solutions from previous search.
         self.reset_results()
@@ -107,10 +124,15 @@ class ICM():
         #assignment = self.get_random_assignment()
         weight = 1
         for _ in range(0, max_iterations):
+            if self.clock.expired():
+                self.timedOut = True
+                break
             assignment, weight = self.icm(assignment, weight)
+            self.clock.improve(self.get_assignment_weight(assignment), assignment)
 
         self.optimalAssignment = assignment
-        print "TOTAL WEIGHT OF ASSIGNMENT =", weight
+        self.optimalWeight = self.get_assignment_weight(assignment)
+        print "TOTAL WEIGHT OF ASSIGNMENT =", self.optimalWeight
 
         print "ending ICM"
 
@@ -134,11 +156,6 @@ class ICM():
         assignment[8] = 85
         assignment[9] = 20
         assignment[10] = -1
-        assignment[('sum', 'budget', 3)] = (60, 100)
-        assignment[('sum', 'budget', 'aggregated')] = 100
-        assignment[('sum', 'budget', 0)] = (0, 10)
-        assignment[('sum', 'budget', 2)] = (50, 60)
-        assignment[('sum', 'budget', 1)] = (10, 50)
 
         return assignment
         # The above assignment corresponds to the following itinerary
@@ -177,28 +194,27 @@ class ICM():
                         assignment[slot] = val
                         break
 
-        aux_budget_vars = [
-            ('sum', 'budget', 0),
-            ('sum', 'budget', 1),
-            ('sum', 'budget', 2),
-            ('sum', 'budget', 3),
-            ('sum', 'budget', 'aggregated'),]
-        for var in aux_budget_vars:
-            for val in self.domains[var]:
-                delta_weight = self.get_delta_weight(assignment, var, val)
-                if delta_weight > 0:
-                    assignment[var] = val
-                    break
-        
         for var in self.csp.variables:
             if var not in assignment:
                 assignment[var] = random.choice(self.domains[var])
 
         return assignment
 
+    def get_assignment_weight(self, assignment):
+        """
+        Returns the weight of the complete |assignment|. The weight icm()
+        carries along is only used to compare the candidates of one variable.
+        """
+        return self.csp.get_assignment_weight(assignment)
+
     def icm(self, assignment, weight):
 
         for var in self.csp.variables:
+            # derived variables are recomputed along with their inputs below
+            if var in self.csp.derivedVars: continue
+            # stop mid-sweep when out of time, the assignment is still complete
+            if self.clock.expired(): break
+
             #get domain values for current var
             ordered_values = self.domains[var]
             random.shuffle(ordered_values)
@@ -213,11 +229,22 @@ class ICM():
                 #creates a copy of current assignment and makes it None so delta weights can test if adding this variable changes existing weights
                 assignCopy = assignment.copy()
                 del assignCopy[var]
+                dependents = [d for d in self.csp.dependentVars[var] if d in assignCopy]
+                for derived in dependents:
+                    del assignCopy[derived]
                 deltaWeight = self.get_delta_weight(assignCopy, var, val)
 
-                #checks if new assignment changes weight of graph
                 if deltaWeight > 0:
+                    # fill the derived variables back in from the new value
                     assignCopy[var] = val
+                    for derived in dependents:
+                        derivedVal = self.csp.get_derived_value(derived, assignCopy)
+                        deltaWeight *= self.get_delta_weight(assignCopy, derived, derivedVal)
+                        if deltaWeight == 0: break
+                        assignCopy[derived] = derivedVal
+
+                #checks if new assignment changes weight of graph
+                if deltaWeight > 0:
                     new_weight = weight * deltaWeight
                     possible_assignments.append((assignCopy, new_weight))
 
@@ -242,6 +269,31 @@ class ICM():
             assert False, "Shouldn't get here"
 
 
+# A partial assignment of beam search: |var| = |val| on top of the partial
+# assignment |parent| (None for the empty one), with the total |weight| and
+# its state |signature| when the search merges states.
+# Extensions share their parent instead of copying it.
+class BeamNode(object):
+    __slots__ = ('parent', 'var', 'val', 'weight', 'signature')
+
+    def __init__(self, parent, var, val, weight, signature = None):
+        self.parent = parent
+        self.var = var
+        self.val = val
+        self.weight = weight
+        self.signature = signature
+
+    def get_assignment(self):
+        """
+        Returns the assignment as a new dictionary of var -> val.
+        """
+        assignment = {}
+        node = self
+        while node.parent is not None:
+            assignment[node.var] = node.val
+            node = node.parent
+        return assignment
+
 class BeamSearch():
     def reset_results(self):
         """
@@ -303,23 +355,10 @@ class BeamSearch():
             will be used as a multiplier on the current weight.
         """
         assert var not in assignment
-        w = 1.0
-        if self.csp.unaryFactors[var]:
-            w *= self.csp.unaryFactors[var][val]
-            if w == 0: return w
-        for var2, factor in self.csp.binaryFactors[var].iteritems():
-            if var2 not in assignment: continue  # Not assigned yet
-            w *= factor[val][assignment[var2]]
-            if w == 0: return w
-        for var2 in self.csp.ternaryFactors[var]:
-            # print self.csp.ternaryFactors[var], "done", var, "done", var2, "HIIIII"
-            for var3, factor in self.csp.ternaryFactors[var][var2].iteritems():
-                if var2 not in assignment or var3 not in assignment: continue  # Not assigned yet
-                w *= factor[val][assignment[var2]][assignment[var3]]
-                if w == 0: return w
-        return w
-
-    def solve(self, csp, mcv = False, ac3 = False, k = 10):
+        return self.csp.get_delta_weight(assignment, var, val)
+
+    def solve(self, csp, mcv = False, ac3 = False, k = 10, time_budget = None, deadline = None, on_improvement = None,
+            vectorized = False, state_signature = None):
         """
         Solves the given weighted CSP using heuristics as specified in the
         parameter. Note that unlike a typical unweighted CSP where the search
@@ -331,9 +370,27 @@ class BeamSearch():
         @param mcv: When enabled, Most Constrained Variable heuristics is used.
         @param ac3: When enabled, AC-3 will be used after each assignment of an
             variable is made.
+        @param time_budget, deadline, on_improvement: see SolveClock. The
+            deadline is checked before each variable is extended. Beam search
+            only has complete assignments at the end, so when time runs out
+            allAssignments holds the partial beam, no optimal assignment is
+            set and timedOut is set.
+        @param vectorized: When enabled, the beam is extended with NumPy array
+            operations instead of one value at a time (see
+            beamsearch_vectorized()). The CSP must be dense; the beam found is
+            the same.
+        @param state_signature: When given, a function(signature, var, val)
+            returning the signature of a partial assignment extended with
+            |var| = |val| from the one of the partial assignment (None for the
+            empty one). Partial assignments with equal signatures are taken
+            to have the same possible futures, so only the best of them is
+            kept and the beam holds k distinct states (see
+            SchedulingCSPConstructor.get_state_signature()).
         """
         # CSP to be solved.
         self.csp = csp
+        self.clock = SolveClock(time_budget, deadline, on_improvement)
+        self.timedOut = False
 
         # Set the search heuristics requested asked.
         self.mcv = mcv
@@ -347,10 +404,14 @@ class BeamSearch():
 
         # Set number of candidate assignments to store at any one time
         self.k = k
+        self.state_signature = state_signature
 
         print "starting beamsearch"
         # Perform backtracking search.
-        self.beamsearch()
+        if vectorized:
+            self.beamsearch_vectorized()
+        else:
+            self.beamsearch()
         print "ending beamsearch"
         # Print summary of solutions.
         #self.print_stats()
@@ -365,58 +426,191 @@ class BeamSearch():
 
         self.numOperations += 1
 
-        # Init with empty assignments of weight 1
-        assignments = [({}, 1)]
+        # Init with the empty assignment of weight 1
+        beam = [BeamNode(None, None, None, 1)]
 
         # Number of variables currently assigned
         num_assigned = 0
 
         for var in self.get_ordered_vars(self.csp):
-            extended = self.extend_assignments(assignments, var)
-            assignments = self.prune_assignments(extended)
+            if self.clock.expired():
+                self.timedOut = True
+                break
+            extended = self.extend_assignments(beam, var)
+            beam = self.prune_assignments(extended)
             #print extended
-            #print assignments
+            #print beam
             num_assigned += 1
-            # for a, w in assignments:
-            #     print a, w
-            if len(assignments) == 0:
+            if len(beam) == 0:
                 print "no assignments after assigning", var
                 break
 
+        # only the final beam is turned into (assignment, weight) pairs
+        self.record_beam([(node.get_assignment(), node.weight) for node in beam])
+
+    def record_beam(self, assignments):
+        """
+        Stores the final beam, a list of (assignment, weight) best first.
+        """
         self.allAssignments = assignments #[a for a, w in assignments]
+        if len(assignments) > 0 and len(assignments[0][0]) == len(self.csp.variables):
+            self.optimalAssignment, self.optimalWeight = assignments[0]
+            self.clock.improve(self.optimalWeight, self.optimalAssignment)
+
+    def beamsearch_vectorized(self):
+        """
+        Beam search over a dense CSP with the whole beam in arrays: row r of
+        |beam| holds the value positions of the r-th partial assignment, one
+        column per variable in the order they are assigned. For each variable
+        the delta weights of all (assignment, value) pairs come from
+        CSP.get_delta_weight_matrix(), and select_top_k() keeps the k best
+        pairs in the order beamsearch() would. State signatures, if any, are
+        kept in a list parallel to the rows.
+        """
+        csp = self.csp
+        if not csp.dense:
+            raise Exception("Vectorized beam search needs a dense CSP")
+
+        self.numOperations += 1
+
+        ordered_vars = self.get_ordered_vars(csp)
+        # Init with the empty assignment of weight 1
+        beam = np.zeros((1, len(ordered_vars)), dtype=int)
+        weights = np.ones(1)
+        signatures = [None]
+
+        # Number of variables currently assigned
+        num_assigned = 0
+
+        for var in ordered_vars:
+            if self.clock.expired():
+                self.timedOut = True
+                break
+            columns = {v: beam[:, i] for i, v in enumerate(ordered_vars[:num_assigned])}
+            extended = weights[:, None] * csp.get_delta_weight_matrix(columns, var)
+            if self.state_signature is not None:
+                rows, positions, signatures = self.select_distinct(extended, var, signatures)
+            else:
+                rows, positions = self.select_top_k(extended)
+            beam = beam[rows]
+            beam[:, num_assigned] = positions
+            weights = extended[rows, positions]
+            num_assigned += 1
+            if len(weights) == 0:
+                print "no assignments after assigning", var
+                break
+
+        assigned = ordered_vars[:num_assigned]
+        self.record_beam([({var: csp.values[var][beam[r, i]] for i, var in enumerate(assigned)}, float(weights[r])) \
+            for r in range(len(weights))])
 
-    def extend_assignments(self, assignments, var):
+    def select_top_k(self, extended):
+        """
+        Returns the (rows, columns) of the k largest nonzero entries of
+        |extended|, largest first. Equal entries are taken in row major order,
+        which is the order beamsearch() makes the extensions in, so the beam
+        is the same. The k-th largest weight is found with a partition; only
+        the k survivors are sorted.
+        """
+        flat = extended.ravel()
+        live = np.flatnonzero(flat > 0)
+        if len(live) > self.k:
+            liveWeights = flat[live]
+            kth = np.partition(liveWeights, len(live) - self.k)[len(live) - self.k]
+            above = live[liveWeights > kth]
+            ties = live[liveWeights == kth][:self.k - len(above)]
+            live = np.concatenate([above, ties])
+        live = live[np.lexsort((live, -flat[live]))]
+        return np.unravel_index(live, extended.shape)
+
+    def select_distinct(self, extended, var, signatures):
+        """
+        select_top_k() with state signatures: goes through the nonzero
+        entries of |extended| in the same order and keeps the first k with
+        distinct signatures, which are the best of their signature. Returns
+        the rows, the columns and the signatures of the ones kept.
+        """
+        flat = extended.ravel()
+        live = np.flatnonzero(flat > 0)
+        live = live[np.lexsort((live, -flat[live]))]
+        rows, positions = np.unravel_index(live, extended.shape)
+        values = self.csp.values[var]
+        seen = set()
+        kept = []
+        keptSignatures = []
+        for i in range(len(live)):
+            signature = self.state_signature(signatures[rows[i]], var, values[positions[i]])
+            if signature in seen: continue
+            seen.add(signature)
+            kept.append(i)
+            keptSignatures.append(signature)
+            if len(kept) == self.k: break
+        kept = np.array(kept, dtype=int)
+        return rows[kept], positions[kept], keptSignatures
+
+    def extend_assignments(self, beam, var):
         """
         Extends the partial assignments passed in by choosing an unassigned
         variable and returning all possible partial assignments with that
-        chosen variable assigned
+        chosen variable assigned. Each BeamNode of |beam| is materialized as a
+        dictionary once to weigh its values; the extensions are child nodes
+        sharing it as their parent.
+
+        Only the k best extensions are kept, in a min-heap of (weight,
+        -order, node) where order counts the candidates: among equal weights
+        the earlier one ranks higher, as in a stable sort of all of them. A
+        candidate that can't beat the root of a full heap is dropped before
+        its node is made. |beam| is sorted best first, so once even the upper
+        bound of |var| (see CSP.get_weight_upper_bound()) can't lift a node
+        above the root, the rest of the beam can't either.
+
+        With a state signature, all the extensions are ranked the same way,
+        but only the best one of each signature is kept.
         """
-        ordered_values = self.domains[var]
-        extended_assignments = [] # list of tuples of the form (assignment, weight)
+        extended_assignments = [] # heap of (weight, -order, BeamNode)
+        merged = {} # signature -> best (weight, -order, BeamNode)
+        order = 0
+        bound = self.csp.get_weight_upper_bound(var)
 
-        for assignment, weight in assignments:
+        for node in beam:
+            if len(extended_assignments) >= self.k and node.weight * bound <= extended_assignments[0][0]:
+                break
+            assignment = node.get_assignment()
+            ordered_values = self.domains[var]
+            if var in self.csp.derivedVars:
+                # A derived variable only takes the value computed from its inputs.
+                value = self.csp.get_derived_value(var, assignment)
+                if value is not None:
+                    ordered_values = [value] if value in ordered_values else []
             for val in ordered_values:
                 deltaWeight = self.get_delta_weight(assignment, var, val)
                 if deltaWeight > 0:
-                    # Copy assignment with new var, val pair into extended assignments
-                    #print "dw > 0"
-                    newAssignment = copy.deepcopy(assignment)
-                    newAssignment[var] = val
-                    newWeight = weight * deltaWeight
-                    extended_assignments.append((newAssignment, newWeight))
-
+                    order += 1
+                    newWeight = node.weight * deltaWeight
+                    if self.state_signature is not None:
+                        signature = self.state_signature(node.signature, var, val)
+                        if signature not in merged or newWeight > merged[signature][0]:
+                            merged[signature] = (newWeight, -order, BeamNode(node, var, val, newWeight, signature))
+                    elif len(extended_assignments) < self.k:
+                        heapq.heappush(extended_assignments, (newWeight, -order, BeamNode(node, var, val, newWeight)))
+                    elif newWeight > extended_assignments[0][0]:
+                        heapq.heapreplace(extended_assignments, (newWeight, -order, BeamNode(node, var, val, newWeight)))
+
+        if self.state_signature is not None:
+            return merged.values()
         return extended_assignments
 
     def prune_assignments(self, assignments):
         """
-        Returns the k assignments with the highest weights
+        Returns the k assignments with the highest weights, best first, from
+        the heap built by extend_assignments()
         """
-        # Sort assignments by weight
-        assignments.sort(key=lambda (assignment, weight): weight, reverse=True)
+        # Sort assignments by weight, then by the order they were made in
+        assignments.sort(reverse=True)
 
         # Return top k assignments
         #print len(assignments)
-        new_assignments = assignments[:self.k]
+        new_assignments = [node for weight, order, node in assignments[:self.k]]
         return new_assignments
 
 
@@ -427,20 +621,15 @@ class BeamSearch():
         # ordered_vars.extend([('sum', 'food', 'aggregated'),
         #     ('sum', 'food', 0), ('sum', 'food', 1), ('sum', 'food', 2),
         #     ('sum', 'food', 3), ('sum', 'food', 4)])
-        # all slot variables
-        ordered_vars.extend(i for i in range(0, num_slots))
+        # home slots first, so that the travel times to and from home count
+        # with their real values as soon as their other end is placed
+        ordered_vars.extend([0, num_slots - 1])
+        # all other slot variables
+        ordered_vars.extend(i for i in range(1, num_slots - 1))
         # # activity vars
         # ordered_vars.extend(i for i in range(0, num_slots) if i % 2 == 0)
         # # time vars
         # ordered_vars.extend(i for i in range(0, num_slots) if i % 2 != 0)
-        # budget vars
-        ordered_vars.extend([
-            ('sum', 'budget', 0),
-            ('sum', 'budget', 1),
-            ('sum', 'budget', 2),
-            ('sum', 'budget', 3),
-            ('sum', 'budget', 'aggregated')])
-
 
         # ordered_vars.extend([
         #     ('sum', 'act_time', 'aggregated'),
@@ -456,12 +645,37 @@ class BeamSearch():
         #     ('sum', 'travel_time', 1),
         #     ('sum', 'travel_time', 0)])
 
+        # never branch on a derived variable: assign it right after its inputs
+        ordered_vars = self.csp.defer_derived_variables(ordered_vars)
+
         print "assigning variables in beam search in this order:"
         print ordered_vars
 
         assert(len(self.csp.variables) == len(ordered_vars))
         return ordered_vars
 
+# The domains of a search, a dictionary of var -> list of values that
+# records every replaced domain on a trail. Domains are never modified in
+# place, only replaced (self.domains[var] = new_list), so undoing back to a
+# mark restores them exactly.
+class TrailDomains(dict):
+    def __init__(self, domains):
+        dict.__init__(self, domains)
+        self.trail = []
+
+    def __setitem__(self, var, values):
+        self.trail.append((var, self[var]))
+        dict.__setitem__(self, var, values)
+
+    def mark(self):
+        return len(self.trail)
+
+    def undo(self, mark):
+        trail = self.trail
+        while len(trail) > mark:
+            var, values = trail.pop()
+            dict.__setitem__(self, var, values)
+
 # A backtracking algorithm that solves weighted CSP.
 # Usage:
 #   search = BacktrackingSearch()
@@ -525,23 +739,10 @@ class BacktrackingSearch():
             will be used as a multiplier on the current weight.
         """
         assert var not in assignment
-        w = 1.0
-        if self.csp.unaryFactors[var]:
-            w *= self.csp.unaryFactors[var][val]
-            if w == 0: return w
-        for var2, factor in self.csp.binaryFactors[var].iteritems():
-            if var2 not in assignment: continue  # Not assigned yet
-            w *= factor[val][assignment[var2]]
-            if w == 0: return w
-        for var2 in self.csp.ternaryFactors[var]:
-            # print self.csp.ternaryFactors[var], "done", var, "done", var2, "HIIIII"
-            for var3, factor in self.csp.ternaryFactors[var][var2].iteritems():
-                if var2 not in assignment or var3 not in assignment: continue  # Not assigned yet
-                w *= factor[val][assignment[var2]][assignment[var3]]
-                if w == 0: return w
-        return w
-
-    def solve(self, csp, mcv = False, ac3 = False, max_num_assignments = 10):
+        return self.csp.get_delta_weight(assignment, var, val)
+
+    def solve(self, csp, mcv = False, ac3 = False, max_num_assignments = 10, branch_and_bound = False, processes = 1,
+            time_budget = None, deadline = None, on_improvement = None, num_best = None):
         """
         Solves the given weighted CSP using heuristics as specified in the
         parameter. Note that unlike a typical unweighted CSP where the search
@@ -553,34 +754,183 @@ class BacktrackingSearch():
         @param mcv: When enabled, Most Constrained Variable heuristics is used.
         @param ac3: When enabled, AC-3 will be used after each assignment of an
             variable is made.
+        @param branch_and_bound: When enabled, search for the optimal weight
+            instead: values are tried best first and a partial assignment is
+            dropped once its weight times the upper bound of the unassigned
+            variables (see CSP.get_weight_upper_bound()) can't reach
+            optimalWeight. max_num_assignments is ignored, allAssignments
+            lists each improving solution and allOptimalAssignments the optimal
+            ones.
+        @param processes: When more than 1, the search tree is split at the
+            first variable with several values and the subtrees are searched
+            by a pool of that many processes (see solve_parallel()).
+        @param time_budget, deadline, on_improvement: see SolveClock. When
+            time runs out the search stops with the solutions found so far and
+            timedOut is set. on_improvement is called for each new optimal
+            weight (by the parent process once the units are merged in
+            parallel mode).
+        @param num_best: When set, search for the num_best highest weight
+            assignments with branch and bound, pruning against the weight of
+            the num_best-th best found so far. Only those are kept, in a
+            bounded heap; allAssignments and assignmentWeights list them best
+            first (ties in the order they were found) and max_num_assignments
+            is ignored.
+        """
+        remaining = self.prepare(csp, mcv, ac3, max_num_assignments, branch_and_bound,
+            SolveClock(time_budget, deadline, on_improvement), num_best)
+
+        print "starting backtrack"
+        if processes > 1:
+            self.solve_parallel(processes, remaining)
+        else:
+            # Perform backtracking search.
+            self.backtrack({}, 0, 1, remaining)
+        self.collect_best()
+        print "ending backtrack"
+        # Print summary of solutions.
+        self.print_stats()
+
+    def prepare(self, csp, mcv, ac3, max_num_assignments, branch_and_bound, clock, num_best = None):
+        """
+        Sets up the state of a search, see solve() for the parameters. Returns
+        the weight bound of the whole CSP in branch and bound mode (else None).
         """
         # CSP to be solved.
         self.csp = csp
+        self.clock = clock
+        self.timedOut = False
 
         # Set the search heuristics requested asked.
         self.mcv = mcv
         self.ac3 = ac3
+        self.branch_and_bound = branch_and_bound or num_best is not None
+        self.numBest = num_best
 
         # Reset solutions from previous search.
         self.reset_results()
+        # Weight of each entry of allAssignments.
+        self.assignmentWeights = []
+        # With num_best, min-heap of the best (weight, -order found,
+        # assignment) so far; the root is the next one to drop.
+        self.bestHeap = []
+        # Best weight and number of solutions found by all the processes of
+        # a parallel search.
+        self.sharedBest = None
+        self.sharedCount = None
 
         # The dictionary of domains of every variable in the CSP.
-        self.domains = {var: list(self.csp.values[var]) for var in self.csp.variables}
+        self.domains = TrailDomains((var, list(self.csp.values[var])) for var in self.csp.variables)
+
+        # Last support found for each value during arc consistency checks.
+        self.residues = {}
 
         # Set maximum number of assignments
         self.max_num_assignments = max_num_assignments
 
-        print "starting backtrack"
-        # Perform backtracking search.
-        self.backtrack({}, 0, 1)
-        print "ending backtrack"
-        # Print summary of solutions.
-        self.print_stats()
+        # Upper bound on the weight each variable can still add, their product
+        # over the unassigned variables is carried down the search.
+        remaining = None
+        if self.branch_and_bound:
+            self.upperBounds = {var: self.csp.get_weight_upper_bound(var) for var in self.csp.variables}
+            remaining = 1.0
+            for var in self.csp.variables:
+                remaining *= self.upperBounds[var]
 
-    def backtrack(self, assignment, numAssigned, weight):
+        if self.mcv:
+            self.init_mcv()
+        self.initialRemaining = remaining
+        return remaining
+
+    def solve_parallel(self, processes, remaining):
+        """
+        Assigns the variables that have a single feasible value, then hands
+        each value of the first variable with several to a pool of
+        |processes| forked workers (see run_work_unit()). Units are handed
+        out one at a time, so idle workers pick up the next one. In branch
+        and bound mode the workers share the best weight found so far,
+        otherwise they share the number of solutions found and all stop at
+        max_num_assignments. The results are merged in the order of the
+        values; without branch and bound the solutions kept are the first
+        max_num_assignments of that order among the ones found, which are not
+        always the ones a single process finds first.
+        """
+        global parallel_search
+        assignment = {}
+        prefix = []
+        numAssigned = 0
+        weight = 1
+        while True:
+            frame = self.visit(assignment, numAssigned, weight, remaining)
+            if frame is None: return
+            var, ordered_values, remaining, deltas = frame[0], frame[1], frame[6], frame[7]
+            if deltas is None:
+                deltas = [self.get_delta_weight(assignment, var, val) for val in ordered_values]
+            values = [(val, deltaWeight) for val, deltaWeight in zip(ordered_values, deltas) if deltaWeight > 0]
+            if len(values) == 0: return
+            if len(values) > 1: break
+            val, deltaWeight = values[0]
+            prefix.append((var, val))
+            self.assign_value(assignment, var, val, frame)
+            numAssigned += 1
+            weight *= deltaWeight
+
+        units = [prefix + [(var, val)] for val, deltaWeight in values]
+        if self.branch_and_bound:
+            self.sharedBest = multiprocessing.Value('d', 0.0)
+        else:
+            self.sharedCount = multiprocessing.Value('i', 0)
+        # the workers are forked, so they see this search (and its CSP, whose
+        # factor functions can't be pickled) without sending it over
+        parallel_search = self
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = sorted(pool.imap_unordered(run_work_unit, list(enumerate(units)), chunksize = 1))
+        finally:
+            pool.close()
+            pool.join()
+            parallel_search = None
+
+        for index, numOperations, firstAssignmentNumOperations, solutions, timedOut in results:
+            self.timedOut = self.timedOut or timedOut
+            for newAssignment, weight in solutions:
+                if not self.branch_and_bound and self.numAssignments >= self.max_num_assignments: break
+                first = self.firstAssignmentNumOperations == 0
+                self.record_assignment(newAssignment, weight)
+                if first and self.firstAssignmentNumOperations != 0:
+                    self.firstAssignmentNumOperations = self.numOperations + firstAssignmentNumOperations
+            self.numOperations += numOperations
+
+    def replay(self, prefix):
+        """
+        Assigns |prefix|, a list of (var, val) pairs in the order the search
+        would pick the variables, then searches the rest of the tree. Only
+        the operations below |prefix| are counted.
+        """
+        assignment = {}
+        numAssigned = 0
+        weight = 1
+        remaining = self.initialRemaining
+        for var, val in prefix:
+            frame = self.visit(assignment, numAssigned, weight, remaining)
+            # the other workers may already have found enough solutions
+            if frame is None: break
+            assert frame[0] == var
+            remaining = frame[6]
+            weight *= self.get_delta_weight(assignment, var, val)
+            self.assign_value(assignment, var, val, frame)
+            numAssigned += 1
+        else:
+            self.numOperations = 0
+            self.backtrack(assignment, numAssigned, weight, remaining)
+            return
+        self.numOperations = 0
+
+    def backtrack(self, assignment, numAssigned, weight, remaining = None):
         """
         Perform the back-tracking algorithms to find all possible solutions to
-        the CSP.
+        the CSP. The search runs on an explicit stack instead of recursing;
+        each frame is one node still trying values for its variable, and
+        domains pruned by AC-3 are restored from the trail of self.domains.
 
         @param assignment: A dictionary of current assignment. Unassigned variables
             do not have entries, while an assigned variable has the assigned value
@@ -588,71 +938,284 @@ class BacktrackingSearch():
             and 6 was assigned to it, then assignment[A] == 6.
         @param numAssigned: Number of currently assigned variables
         @param weight: The weight of the current partial assignment.
+        @param remaining: Branch and bound only, upper bound on the weight the
+            unassigned variables can add.
+        """
+        stack = []
+        frame = self.visit(assignment, numAssigned, weight, remaining)
+        if frame is not None: stack.append(frame)
+        while stack:
+            if self.clock.expired():
+                self.timedOut = True
+                break
+            # frame: [var, ordered_values, next value index, numAssigned,
+            #         weight, trail mark of the assigned child or None,
+            #         bound of the children, their delta weights or None]
+            frame = stack[-1]
+            var, ordered_values, i, numAssigned, weight, mark, remaining, deltas, mcvMark = frame
+            if mark is not None:
+                # undo the child we just came back from
+                del assignment[var]
+                self.domains.undo(mark)
+                if self.mcv: self.undo_mcv(mcvMark, var)
+                frame[5] = None
+            child = None
+            while i < len(ordered_values):
+                val = ordered_values[i]
+                if deltas is not None:
+                    deltaWeight = deltas[i]
+                    # values are sorted by delta weight, none of the rest can
+                    # beat the best assignment either
+                    best = self.get_best_weight()
+                    if best > 0 and weight * deltaWeight * remaining < best:
+                        i = len(ordered_values)
+                        break
+                else:
+                    deltaWeight = self.get_delta_weight(assignment, var, val)
+                i += 1
+                if deltaWeight > 0:
+                    self.assign_value(assignment, var, val, frame)
+                    child = self.visit(assignment, numAssigned + 1, weight * deltaWeight, remaining)
+                    break
+            frame[2] = i
+            if frame[5] is None:
+                # all values tried
+                stack.pop()
+            elif child is not None:
+                stack.append(child)
+
+    def assign_value(self, assignment, var, val, frame):
+        """
+        Sets |var| = |val| below |frame|, recording in it what to undo.
+        """
+        frame[5] = self.domains.mark()
+        assignment[var] = val
+        if self.ac3:
+            # fix value for the selected variable so that hopefully we
+            # can eliminate values for other variables
+            self.domains[var] = [val]
+            # enforce arc consistency
+            self.arc_consistency_check(var)
+        if self.mcv:
+            frame[8] = (len(self.mcvTrail), len(self.mcvPending))
+            self.update_mcv(var, frame[5])
+
+    def get_best_weight(self):
+        """
+        Returns the weight to beat in branch and bound mode: the best weight
+        found, or with num_best the weight of the num_best-th best once that
+        many have been found.
         """
+        best = self.optimalWeight
+        if self.numBest is not None:
+            best = self.bestHeap[0][0] if len(self.bestHeap) >= self.numBest else 0
+        if self.sharedBest is not None:
+            return max(best, self.sharedBest.value)
+        return best
+
+    def record_assignment(self, newAssignment, weight):
+        """
+        Updates the statistics with a complete assignment of |weight|.
+        """
+        self.numAssignments += 1
+        if self.numBest is not None:
+            entry = (weight, -self.numAssignments, newAssignment)
+            if len(self.bestHeap) < self.numBest:
+                heapq.heappush(self.bestHeap, entry)
+            elif entry > self.bestHeap[0]:
+                heapq.heapreplace(self.bestHeap, entry)
+        else:
+            self.allAssignments.append(newAssignment)
+            self.assignmentWeights.append(weight)
 
+        if len(self.optimalAssignment) == 0 or weight >= self.optimalWeight:
+            if weight == self.optimalWeight:
+                self.numOptimalAssignments += 1
+                self.allOptimalAssignments.append(newAssignment)
+            else:
+                self.numOptimalAssignments = 1
+                self.allOptimalAssignments = [newAssignment]
+            self.optimalWeight = weight
+
+            self.optimalAssignment = newAssignment
+            if self.firstAssignmentNumOperations == 0:
+                self.firstAssignmentNumOperations = self.numOperations
+            self.clock.improve(weight, newAssignment)
+
+        if self.sharedCount is not None:
+            with self.sharedCount.get_lock():
+                self.sharedCount.value += 1
+        if self.sharedBest is not None:
+            # every process can prune against the best bound any of them has
+            best = self.get_best_weight()
+            if best > self.sharedBest.value:
+                with self.sharedBest.get_lock():
+                    if best > self.sharedBest.value:
+                        self.sharedBest.value = best
+
+    def collect_best(self):
+        """
+        With num_best, lists the assignments kept in the heap, best first, in
+        allAssignments and assignmentWeights.
+        """
+        if self.numBest is None: return
+        best = sorted(self.bestHeap, reverse = True)
+        self.allAssignments = [assignment for weight, order, assignment in best]
+        self.assignmentWeights = [weight for weight, order, assignment in best]
+
+    def visit(self, assignment, numAssigned, weight, remaining = None):
+        """
+        Visit a node of the search: record a complete assignment, or return
+        the frame that will try the values of the next variable (None when
+        there is nothing to expand).
+        """
         self.numOperations += 1
         assert weight > 0
 
-        if self.numAssignments >= self.max_num_assignments: return
+        if not self.branch_and_bound:
+            if self.numAssignments >= self.max_num_assignments: return None
+            if self.sharedCount is not None and self.sharedCount.value >= self.max_num_assignments: return None
 
         if numAssigned == self.csp.numVars:
             # A satisfiable solution have been found. Update the statistics.
-            self.numAssignments += 1
             newAssignment = {}
             for var in self.csp.variables:
                 newAssignment[var] = assignment[var]
-            self.allAssignments.append(newAssignment)
-
-            if len(self.optimalAssignment) == 0 or weight >= self.optimalWeight:
-                if weight == self.optimalWeight:
-                    self.numOptimalAssignments += 1
-                    self.allOptimalAssignments.append(newAssignment)
-                else:
-                    self.numOptimalAssignments = 1
-                    self.allOptimalAssignments = [newAssignment]
-                self.optimalWeight = weight
-
-                self.optimalAssignment = newAssignment
-                if self.firstAssignmentNumOperations == 0:
-                    self.firstAssignmentNumOperations = self.numOperations
-            return
+            self.record_assignment(newAssignment, weight)
+            return None
 
         # Select the next variable to be assigned.
         var = self.get_unassigned_variable(assignment)
         # Get an ordering of the values.
         ordered_values = self.domains[var]
+        if var in self.csp.derivedVars:
+            # A derived variable only takes the value computed from its inputs.
+            value = self.csp.get_derived_value(var, assignment)
+            if value is not None:
+                ordered_values = [value] if value in ordered_values else []
+        deltas = None
+        if self.branch_and_bound:
+            # try the values best first, so good solutions tighten the bound
+            # early, and take |var| out of the bound of the children
+            weighted = [(self.get_delta_weight(assignment, var, val), val) for val in ordered_values]
+            weighted.sort(key = lambda pair: -pair[0])
+            ordered_values = [val for deltaWeight, val in weighted]
+            deltas = [deltaWeight for deltaWeight, val in weighted]
+            if self.upperBounds[var] > 0:
+                remaining = remaining / self.upperBounds[var]
+        return [var, ordered_values, 0, numAssigned, weight, None, remaining, deltas, None]
+
+    def init_mcv(self):
+        """
+        Sets up the incremental MCV state: the live values (nonzero weight,
+        still in the domain) of every non-derived variable and a heap of
+        (count, position, var) entries. Weights only drop to 0 as the
+        assignment grows and domains only shrink, so when a variable is
+        assigned the live values of the variables it affects are filtered,
+        never recounted: by the factors linking them, and by the constraints
+        it takes part in through their filter_values() (an all-different
+        constraint only drops the value just used, a sum compares each value
+        with the slack left). Variables whose domains AC-3 reduced are
+        intersected with their new domain. The filtering waits until a
+        variable actually has to be selected, and stale heap entries are
+        skipped when popped.
+        """
+        csp = self.csp
+        self.varPosition = {var: i for i, var in enumerate(csp.variables)}
+        # var -> {affected var -> constraints of the latter that depend on
+        # var, directly or through the inputs of a derived variable}
+        self.mcvWatch = {var: {} for var in csp.variables}
+        for constraint in csp.constraints:
+            depends = set(constraint.variables)
+            for var in constraint.variables:
+                if var in csp.derivedVars: depends.update(csp.derivedVars[var].inputs)
+            for changed in depends:
+                for var in set(constraint.variables):
+                    if var == changed or var in csp.derivedVars: continue
+                    self.mcvWatch[changed].setdefault(var, []).append(constraint)
+        # var -> variables sharing a binary or ternary factor with it
+        self.factorNeighbors = {}
+        for var in csp.variables:
+            neighbors = set(csp.binaryFactors[var])
+            for var2 in csp.ternaryFactors[var]:
+                neighbors.add(var2)
+                neighbors.update(csp.ternaryFactors[var][var2])
+            self.factorNeighbors[var] = neighbors
+        self.liveValues = {}
+        for var in csp.variables:
+            if var not in csp.derivedVars:
+                self.liveValues[var] = [val for val in self.domains[var] if self.get_delta_weight({}, var, val) != 0]
+        self.mcvHeap = [(len(values), self.varPosition[var], var) for var, values in self.liveValues.iteritems()]
+        heapq.heapify(self.mcvHeap)
+        # (var, previous live values) for every filtered variable, to undo
+        self.mcvTrail = []
+        # (assigned var, None) or (None, var whose domain was replaced) to
+        # process before the next selection
+        self.mcvPending = []
+
+    def update_mcv(self, var, mark):
+        """
+        Queues the assignment of |var| and the domains replaced since trail
+        mark |mark| for the next flush_mcv().
+        """
+        self.mcvPending.append((var, None))
+        for i in xrange(mark, len(self.domains.trail)):
+            self.mcvPending.append((None, self.domains.trail[i][0]))
 
-        # Continue the backtracking recursion using |var| and |ordered_values|.
-        if not self.ac3:
-            # When arc consistency check is not enabled.
-            for val in ordered_values:
-                deltaWeight = self.get_delta_weight(assignment, var, val)
-                if deltaWeight > 0:
-                    assignment[var] = val
-                    self.backtrack(assignment, numAssigned + 1, weight * deltaWeight)
-                    del assignment[var]
-        else:
-            # Arc consistency check is enabled.
-            # Problem 1c: skeleton code for AC-3
-            # You need to implement arc_consistency_check().
-            for val in ordered_values:
-                deltaWeight = self.get_delta_weight(assignment, var, val)
-                if deltaWeight > 0:
-                    assignment[var] = val
-                    # create a deep copy of domains as we are going to look
-                    # ahead and change domain values
-                    localCopy = copy.deepcopy(self.domains)
-                    # fix value for the selected variable so that hopefully we
-                    # can eliminate values for other variables
-                    self.domains[var] = [val]
-
-                    # enforce arc consistency
-                    self.arc_consistency_check(var)
-
-                    self.backtrack(assignment, numAssigned + 1, weight * deltaWeight)
-                    # restore the previous domains
-                    self.domains = localCopy
-                    del assignment[var]
+    def filter_live_values(self, assignment, var, values, changed):
+        """
+        Drops the |values| of |var| that assigning |changed| made infeasible.
+        """
+        if changed in self.factorNeighbors[var]:
+            values = [val for val in values if self.csp.get_factor_delta_weight(assignment, var, val) != 0]
+        for constraint in self.mcvWatch[changed].get(var, ()):
+            if not values: break
+            if hasattr(constraint, 'filter_values'):
+                values = constraint.filter_values(assignment, var, values, changed)
+            else:
+                values = [val for val in values if constraint.get_weight(assignment, var, val) != 0]
+        return values
+
+    def flush_mcv(self, assignment):
+        """
+        Filters the live values of the unassigned variables affected by what
+        was queued.
+        """
+        live = self.liveValues
+        filtered = set()
+        for changed, var in self.mcvPending:
+            if changed is None:
+                if var in assignment or var not in live: continue
+                domain = set(self.domains[var])
+                updates = [(var, [val for val in live[var] if val in domain])]
+            else:
+                affected = self.factorNeighbors[changed].union(self.mcvWatch[changed])
+                updates = [(var, self.filter_live_values(assignment, var, live[var], changed))
+                    for var in affected if var not in assignment and var in live]
+            for var, values in updates:
+                if len(values) == len(live[var]): continue
+                if var not in filtered:
+                    filtered.add(var)
+                    self.mcvTrail.append((var, live[var]))
+                live[var] = values
+        for var in filtered:
+            heapq.heappush(self.mcvHeap, (len(live[var]), self.varPosition[var], var))
+        del self.mcvPending[:]
+
+    def undo_mcv(self, mark, var):
+        """
+        Drops what was queued and restores the live values recorded since
+        |mark|, then puts |var|, unassigned again, back on the heap.
+        """
+        trailMark, pendingMark = mark
+        del self.mcvPending[pendingMark:]
+        trail = self.mcvTrail
+        while len(trail) > trailMark:
+            var2, values = trail.pop()
+            self.liveValues[var2] = values
+            heapq.heappush(self.mcvHeap, (len(values), self.varPosition[var2], var2))
+        if var in self.liveValues:
+            heapq.heappush(self.mcvHeap, (len(self.liveValues[var]), self.varPosition[var], var))
 
     def get_unassigned_variable(self, assignment):
         """
@@ -664,8 +1227,15 @@ class BacktrackingSearch():
         @return var: a currently unassigned variable.
         """
 
+        # Derived variables are filled in as soon as their inputs are assigned
+        # and are never branched on otherwise.
+        derived = self.csp.get_ready_derived_variable(assignment)
+        if derived is not None: return derived
+
         if not self.mcv:
             # Select a variable without any heuristics.
+            for var in self.csp.variables:
+                if var not in assignment and var not in self.csp.derivedVars: return var
             for var in self.csp.variables:
                 if var not in assignment: return var
         else:
@@ -677,19 +1247,22 @@ class BacktrackingSearch():
             #       assignment, a variable, and a proposed value to this variable
             # Hint: for ties, choose the variable with lowest index in self.csp.variables
             # BEGIN_YOUR_CODE (our solution is 7 lines of code, but don't worry if you deviate from this)
-            min_num = float("inf")
-            min_var = self.csp.variables[0]
-            num = 0
-            for var in self.csp.variables:
-                num = 0
-                if var not in assignment:
-                    values = self.domains[var]
-                    for value in values:
-                        if self.get_delta_weight(assignment, var, value) != 0:
-                            num = num+1
-                    if num < min_num:
-                        min_num = num
-                        min_var = var
+            # The counts are maintained by update_mcv(), the heap top is the
+            # answer once entries for assigned variables and outdated counts
+            # are dropped. Ties go to the lowest index as the positions are
+            # part of the entries.
+            self.flush_mcv(assignment)
+            heap = self.mcvHeap
+            min_var = None
+            while heap:
+                count, position, var = heap[0]
+                if var not in assignment and len(self.liveValues[var]) == count:
+                    min_var = var
+                    break
+                heapq.heappop(heap)
+            if min_var is None:
+                for var in self.csp.variables:
+                    if var not in assignment: return var
             return min_var
             # END_YOUR_CODE
 
@@ -697,6 +1270,9 @@ class BacktrackingSearch():
         """
         Perform the AC-3 algorithm. The goal is to reduce the size of the
         domain values for the unassigned variables based on arc consistency.
+        Binary and ternary factors are revised with residual supports (the
+        last support found for a value is checked first, AC-3rm style) and
+        global constraints prune their own variables.
 
         @param var: The variable whose value has just been set.
         """
@@ -710,38 +1286,126 @@ class BacktrackingSearch():
         #   => self.csp.unaryFactors[var1][val1] == 0
         #
         # - For binary factors
-        #   => self.csp.binaryFactors[var1][var2][val1][val2] == 0
-        #   (self.csp.binaryFactors[var1][var2] returns a nested dict of all assignments)
+        #   => self.csp.get_binary_weight(var1, var2, val1, val2) == 0
+        #   (works for both the dict and the dense storage of the CSP)
 
         # BEGIN_YOUR_CODE (our solution is 20 lines of code, but don't worry if you deviate from this)
-        variables = [var]
-        while len(variables) > 0:
-            var1 = variables.pop(0)
-            for var2 in self.csp.get_neighbor_vars(var1):
-                remove_vals = []
-                for val2 in self.domains[var2]:
-                    should_remove = 1
-                    for val1 in self.domains[var1]:
-                        if self.csp.binaryFactors[var1][var2][val1][val2] != 0:
-                            should_remove = 0
-                    if should_remove == 1:
-                        remove_vals.append(val2)
-                curr_domain = self.domains[var2]
-                new_domain = []
-                pruned_domain = 0
-                for val in curr_domain:
-                    if val not in remove_vals:
-                        new_domain.append(val)
-                    else:
-                        pruned_domain = 1
-                self.domains[var2] = new_domain
-                if pruned_domain:
-                    # add all of its neighbors
-                    variables.append(var2)
+        # variables whose factors have to be revised, and constraints (such
+        # as all-different) that prune all of their variables in one pass;
+        # a constraint is queued once however many of its variables changed
+        queue = collections.deque()
+        queued = set()
+        constraints = collections.deque()
+        queuedConstraints = set()
+        changed = [var]
+        while True:
+            for var2 in changed:
+                # no assignment is left for a wiped out domain
+                if len(self.domains[var2]) == 0: return
+                if var2 not in queued:
+                    queued.add(var2)
+                    queue.append(var2)
+                for constraint in self.csp.constraintsByVar[var2]:
+                    if id(constraint) not in queuedConstraints:
+                        queuedConstraints.add(id(constraint))
+                        constraints.append(constraint)
+            changed = []
+            if len(queue) > 0:
+                var1 = queue.popleft()
+                queued.discard(var1)
+                for var2 in self.csp.binaryFactors[var1]:
+                    if self.revise_binary(var2, var1): changed.append(var2)
+                for var2 in self.csp.ternaryFactors[var1]:
+                    for var3 in self.csp.ternaryFactors[var1][var2]:
+                        if self.revise_ternary(var2, var1, var3): changed.append(var2)
+            elif len(constraints) > 0:
+                constraint = constraints.popleft()
+                queuedConstraints.discard(id(constraint))
+                changed = constraint.prune(self.domains)
+            else:
+                break
         # END_YOUR_CODE
 
+    def revise_binary(self, var2, var1):
+        """
+        Removes the values of |var2| without a nonzero weight against any
+        value of |var1|. Returns True if the domain of |var2| was reduced.
+        """
+        domain1 = self.domains[var1]
+        set1 = set(domain1)
+        removed = set()
+        for val2 in self.domains[var2]:
+            key = (var2, var1, val2)
+            if key in self.residues and self.residues[key] in set1: continue
+            for val1 in domain1:
+                if self.csp.get_binary_weight(var1, var2, val1, val2) != 0:
+                    self.residues[key] = val1
+                    break
+            else:
+                removed.add(val2)
+        if not removed: return False
+        self.domains[var2] = [val for val in self.domains[var2] if val not in removed]
+        return True
+
+    def revise_ternary(self, var2, var1, var3):
+        """
+        Removes the values of |var2| without a nonzero weight against any
+        pair of values of |var1| and |var3|. Returns True if the domain of
+        |var2| was reduced.
+        """
+        domain1 = self.domains[var1]
+        domain3 = self.domains[var3]
+        set1 = set(domain1)
+        set3 = set(domain3)
+        removed = set()
+        for val2 in self.domains[var2]:
+            key = (var2, var1, var3, val2)
+            if key in self.residues:
+                val1, val3 = self.residues[key]
+                if val1 in set1 and val3 in set3: continue
+            for val1 in domain1:
+                for val3 in domain3:
+                    if self.csp.get_ternary_weight(var1, var2, var3, val1, val2, val3) != 0:
+                        self.residues[key] = (val1, val3)
+                        break
+                else:
+                    continue
+                break
+            else:
+                removed.add(val2)
+        if not removed: return False
+        self.domains[var2] = [val for val in self.domains[var2] if val not in removed]
+        return True
+
+
+
 
+# The search a parallel BacktrackingSearch.solve() is splitting, inherited by
+# the forked workers.
+parallel_search = None
 
+def run_work_unit(unit):
+    """
+    Worker side of BacktrackingSearch.solve_parallel(): searches the subtree
+    below one (index, prefix) unit with the parent's settings. Returns the
+    index, the number of operations below the prefix, the operations to the
+    first recorded solution, the list of (assignment, weight) found and
+    whether the deadline cut the search short.
+    """
+    index, prefix = unit
+    parent = parallel_search
+    # same deadline, but improvements are reported by the parent
+    clock = SolveClock(deadline = parent.clock.deadline)
+    if clock.expired(): return (index, 0, 0, [], True)
+    search = BacktrackingSearch()
+    search.prepare(parent.csp, parent.mcv, parent.ac3, parent.max_num_assignments, parent.branch_and_bound, clock,
+        parent.numBest)
+    search.sharedBest = parent.sharedBest
+    search.sharedCount = parent.sharedCount
+    search.replay(prefix)
+    search.collect_best()
+    return (index, search.numOperations, search.firstAssignmentNumOperations,
+        zip(search.allAssignments, search.assignmentWeights), search.timedOut)
 
 def find_travel_time(a_latitude, a_longitude, b_latitude, b_longitude):
 	return util.haversine_miles(a_latitude, a_longitude, b_latitude, b_longitude)
@@ -771,47 +1435,29 @@ def haversine_miles(lat1, lon1, lat2, lon2):
     return haversine(lat1, lon1, lat2, lon2) * 0.62137119 * time_per_mile
 
 
-def get_sum_variable(csp, name, variables, maxSum, factor, increment):
-    domain = [(a, b) for a in range(0, maxSum + 1, increment) for b in range(0, maxSum + 1, increment)]
-    result = ('sum', name, 'aggregated')
-    csp.add_variable(result, [a for a in range(0, maxSum + 1, increment)])
-
-    # no input variable, result sum should be 0
-    if len(variables) == 0:
-        csp.add_unary_factor(result, lambda val: val == 0)
-        return result
-    for i, X_i in enumerate(variables):
-        # create auxiliary variable for variable i
-        # use systematic naming to avoid naming collision
-        A_i = ('sum', name, i)
-        csp.add_variable(A_i, domain)
-        # incorporate information from X_i
-        csp.add_binary_factor(X_i, A_i, factor)
-        if i == 0:
-            csp.add_unary_factor(A_i, lambda a: a[0] == 0)
-        else:
-            # consistency between A_{i-1} and A_i
-            def factor2(b1, b2):
-                return b1[1] == b2[0]
-            csp.add_binary_factor(('sum', name, i - 1), A_i, factor2)
-
-            if i == len(variables) - 1:
-                csp.add_binary_factor(result, A_i, lambda a, b: a == b[1])
-    return result
-
 # A class providing methods to generate CSP that can solve the day scheduling
 # problem.
 class SchedulingCSPConstructor():
 
-    def __init__(self, activities, profile):
+    def __init__(self, activities, profile, travel_matrix = None):
         self.activities = activities[profile.genre] # dict
         self.profile = profile
         self.num_slots = 11 # always keep this odd!
         self.max_travel_time = 60 #mins
+        self.num_meals = 2 # lunch and dinner when the profile wants food
         self.home = activities['home'] #dict 
         self.restaraunts = activities['food']
         self.act_and_rest = dict(activities[profile.genre])
         self.act_and_rest.update(self.restaraunts)
+        # travel times between every pair of activities, share one across
+        # constructors and the scorer when solving the same catalog repeatedly
+        if travel_matrix is None:
+            travel_matrix = util.TravelMatrix(activities, time_per_mile)
+        self.travel_matrix = travel_matrix
+        # width of the budget ($) and time (minutes) buckets of
+        # get_state_signature(); costs and durations are multiples of 10, so
+        # 10 only merges states that really are interchangeable
+        self.signature_bucket = 10
         print "max travel time is ", self.max_travel_time
 
 
@@ -824,20 +1470,16 @@ class SchedulingCSPConstructor():
         for x in range(0, self.max_travel_time+1, 10):
             time_domain.append(x)
         # print time_domain
-        activities_domain = list(self.activities.keys())
+        # any activity slot can hold a restaurant, add_food_constraints decides
+        # how many of them do
+        activities_domain = list(self.activities.keys()) + list(self.restaraunts.keys())
         home_domain = list(self.home.keys())
-        restaraunts_domain = list(self.restaraunts.keys())
-        lunch = 4
-        dinner = 8
         
         # slots (including the travel time)
         for i in range(0, self.num_slots):
             if i == 0 or i == self.num_slots - 1:
                 csp.add_variable(i, home_domain)
                 continue
-            if i == lunch or i == dinner:
-                csp.add_variable(i, restaraunts_domain)
-                continue
             if i % 2 == 0:
                 # activity
                 csp.add_variable(i, activities_domain) # if an activity/restaraunt slot is not assigned
@@ -846,54 +1488,86 @@ class SchedulingCSPConstructor():
                 csp.add_variable(i, time_domain)
         print "ending add variables"
     
+    def get_activity_cost(self, a):
+        return int(math.ceil(self.act_and_rest[a].cost / 10.0)) * 10 + 10
+
+    def get_activity_time(self, a):
+        return int(math.ceil(self.act_and_rest[a].duration / 10.0)) * 10
+
+    def is_food(self, a):
+        return self.act_and_rest[a].is_food == 1
+
+    def get_travel_duration(self, a, c):
+        return int(math.ceil(self.travel_matrix.get_travel_time(a, c) / 10.0)) * 10 + 10
+
+    def get_travel_durations(self, sources, destinations):
+        """
+        get_travel_duration() from every one of |sources| to every one of
+        |destinations|, as an array.
+        """
+        index = self.travel_matrix.index
+        minutes = self.travel_matrix.minutes[np.ix_([index[a] for a in sources], [index[c] for c in destinations])]
+        return (np.ceil(minutes / 10.0) * 10 + 10).astype(int)
+
+    def get_state_signature(self, signature, var, val):
+        """
+        State signature of a partial schedule for BeamSearch: the last
+        activity (or home), the budget and time used, counted in units of
+        signature_bucket (each cost and duration rounded down), and the set
+        of activities visited, which also fixes the number of meals.
+        Schedules over the same slots that agree on these can be completed in
+        the same ways.
+        """
+        if signature is None:
+            signature = (None, 0, 0, frozenset())
+        last, budget, minutes, visited = signature
+        bucket = self.signature_bucket
+        if var % 2 != 0:
+            # travel slot, |val| is the travel time
+            return (last, budget, minutes + val // bucket, visited)
+        if var == 0 or var == self.num_slots - 1:
+            return (val, budget, minutes, visited)
+        return (val, budget + self.get_activity_cost(val) // bucket,
+            minutes + self.get_activity_time(val) // bucket, visited | frozenset([val]))
+
     # budget: value of (i, "activity") summed up less than user budget
     def add_budget_constraints(self, csp):
         print "starting add budget constraints"
-        def factor(a, b):
-            val = int(math.ceil(self.act_and_rest[a].cost / 10)) * 10 + 10
-            return b[1] == b[0] + val
+        cost = self.get_activity_cost
 
         variables = []
         for i in range(0, self.num_slots):
             if i % 2 == 0 and i != 0 and i != self.num_slots - 1:
                 variables.append(i)
 
-        result = get_sum_variable(csp, "budget", variables, self.profile.budget, factor, 10)
-        csp.add_unary_factor(result, lambda val: val <= self.profile.budget)
+        csp.add_sum_constraint(variables, cost, self.profile.budget)
         print "ending add budget constraints"
 
     # time: value of (i, "activity").duration and (i, "travel").duration summed up less than user time
-    # def add_time_constraints(self, csp):
-    #     print "starting time constaints"
-    #     def activity_factor(a, b):
-    #         val = int(math.ceil(self.activities[a].duration / 10)) * 10
-    #         return b[1] == b[0] + val
+    def add_time_constraints(self, csp):
+        print "starting time constaints"
+        activity_time = self.get_activity_time
 
-    #     def time_factor(a, b):
-    #         return b[1] == b[0] + a
+        def travel_time(b):
+            return b
 
-    #     activity_variables = []
-    #     time_variables = []
-    #     for i in range(0, self.num_slots):
-    #         if i % 2 == 0 and i != 0 and i != self.num_slots-1:
-    #             activity_variables.append(i)
-    #         if i % 2 != 0 and i != 0 and i != self.num_slots-1:
-    #             time_variables.append(i)
-    #     result1 = get_sum_variable(csp, "act_time", activity_variables, self.profile.total_time, activity_factor, 10)
-    #     result2 = get_sum_variable(csp, "travel_time", time_variables, self.profile.total_time, time_factor, 10)
-    #     csp.add_binary_factor(result1, result2, lambda val1, val2: val1 + val2 <= self.profile.total_time)
-    #     print "ending time contraints"
+        costs = {}
+        for i in range(0, self.num_slots):
+            if i % 2 == 0 and i != 0 and i != self.num_slots-1:
+                costs[i] = activity_time
+            if i % 2 != 0 and i != 0 and i != self.num_slots-1:
+                costs[i] = travel_time
+        # the travel slots are derived, so the sum picks up their values as
+        # soon as the surrounding activities are chosen
+        csp.add_sum_constraint(sorted(costs), costs, self.profile.total_time)
+        print "ending time contraints"
 
     # constraint to make activities different in a schedule
     def add_different_activity_constraints(self, csp):
         print "starting add_different_activity_constraints"
-        def factor(a, b):
-            return a != b
-
         # not adding the last variable since it will be home
-        variables = [(i, j) for i in range(0, self.num_slots-1) for j in range(0, self.num_slots-1) if i != j and i % 2 == 0 and j % 2 == 0]
-        for i, j in variables:
-            csp.add_binary_factor(i, j, factor)
+        variables = [i for i in range(0, self.num_slots-1) if i % 2 == 0]
+        csp.add_all_different(variables)
 
         print "ending add_different_activity_constraints"
 
@@ -908,37 +1582,27 @@ class SchedulingCSPConstructor():
     #             csp.add_unary_factor(i, factor)
     #     print "ending add weighted travel time constaints"
 
-    # food: sum number of activities that have food, and if they want food it has to equal one or else 0
-    # def add_food_constraints(self, csp):
-    #     print "starting add food constaints"
-    #     def factor(a, b):
-    #         val = self.activities[a].is_food
-    #         return b[1] == b[0] + val
+    # food: count the activities that have food, it has to equal the number of meals if they want food or else 0
+    def add_food_constraints(self, csp):
+        print "starting add food constaints"
+        is_food = self.is_food
 
-    #     num_restaraunts = self.profile.want_food
-    #     variables = []
-    #     for i in range(0, self.num_slots):
-    #         if i != 0 and i != self.num_slots-1 and i % 2 == 0:
-    #             variables.append(i)
-        
-    #     result = get_sum_variable(csp, "food", variables, num_restaraunts, factor, 1)
-    #     csp.add_unary_factor(result, lambda val: val == num_restaraunts)
-    #     print "ending add food constaints"
+        num_restaraunts = self.num_meals if self.profile.want_food else 0
+        variables = []
+        for i in range(0, self.num_slots):
+            if i != 0 and i != self.num_slots-1 and i % 2 == 0:
+                variables.append(i)
+
+        csp.add_count_constraint(variables, is_food, num_restaraunts, num_restaraunts)
+        print "ending add food constaints"
 
-    # travel time: binary factor where for each travel slot, travel_time(prev_activity, next_activity) = travel_time, set (i, "travel") equal to that
+    # travel time: for each travel slot, travel_time(prev_activity, next_activity) = travel_time, so
+    # the travel slot is derived from its two neighbouring activity slots
     def add_slot_travel_time_constraints(self, csp):
         print "starting add travel time constraints"
         for i in range(1, self.num_slots):
             if i % 2 != 0 and i != self.num_slots:
-                def factor_duration(a, b, c):
-                    if a == -1:
-                        return b == int(math.ceil(haversine_miles(self.home[a].latitude, self.home[a].longitude, self.act_and_rest[c].latitude, self.act_and_rest[c].longitude) / 10)) * 10 + 10
-                    if c == -1:
-                        return b == int(math.ceil(haversine_miles(self.act_and_rest[a].latitude, self.act_and_rest[a].longitude, self.home[c].latitude, self.home[c].longitude) / 10)) * 10 + 10
-                    else:
-                        return b == int(math.ceil(haversine_miles(self.act_and_rest[a].latitude, self.act_and_rest[a].longitude, self.act_and_rest[c].latitude, self.act_and_rest[c].longitude) / 10)) * 10 + 10
-                print i
-                csp.add_ternary_factor(i-1, i, i+1, factor_duration)
+                csp.add_functional_constraint(i, [i-1, i+1], self.get_travel_duration)
         print "ending add travel time constraints"
 
     # rating: for the value of each (i, "activity"), we give a higher weight for a better rating, UNARY FACTOR
@@ -977,22 +1641,286 @@ class SchedulingCSPConstructor():
     #         csp.add_unary_factor(i, factor)
     #     print "ending add_penalize_none_constraints"
 
-    def get_basic_csp(self):
+    def get_basic_csp(self, dense = False, lazy = False):
         """
         Return a CSP that only enforces the basic budget constraints
 
+        @param dense: When enabled, factor tables are stored as NumPy arrays
+            indexed by interned domain positions (see util.CSP).
+        @param lazy: When enabled, factor functions are only evaluated for the
+            combinations the solver looks at (see util.CSP).
         @return csp: A CSP where basic variables and constraints are added.
         """
-        csp = util.CSP()
+        csp = util.CSP(dense = dense, lazy = lazy)
         self.add_variables(csp, self.profile.user_latitude, self.profile.user_longitude)
         self.add_budget_constraints(csp)
         self.add_different_activity_constraints(csp)
         self.add_rating_constraints(csp)
-        # self.add_food_constraints(csp)
+        self.add_food_constraints(csp)
         self.add_review_count_constraints(csp)
         self.add_slot_travel_time_constraints(csp)
-
-        # self.add_time_constraints(csp)
+        self.add_time_constraints(csp)
         # self.add_weighted_travel_time_constraints(csp)
         # self.add_penalize_none_constraints(csp)
         return csp
+
+# An exact solver for the CSPs of SchedulingCSPConstructor.get_basic_csp(),
+# which are a chain: an activity slot only interacts with the next one
+# through the travel slot between them, besides the budget, time and meal
+# totals and the all-different constraint. The state after an activity slot
+# is (activity, budget used, time used, meals), costs, durations and travel
+# times all being multiples of |unit|. A backward max-product (Viterbi) pass
+# over these states gives the best weight the remaining slots can add when
+# activities may repeat, just not back to back. That relaxation is an upper
+# bound for a best-first search forward that enforces all-different, so the
+# first complete schedule it takes off its queue is optimal.
+# Usage:
+#   solver = ChainDPSolver()
+#   solver.solve(constructor, csp)
+class ChainDPSolver():
+    # costs, durations and travel times are multiples of this
+    unit = 10
+
+    def reset_results(self):
+        """
+        Same statistics as the other solvers, plus |exact|: whether the
+        schedule found is proven optimal.
+        """
+        self.optimalAssignment = {}
+        self.optimalWeight = 0
+        self.numOptimalAssignments = 0
+        self.numAssignments = 0
+        # Number of partial schedules expanded by the forward search.
+        self.numOperations = 0
+        self.firstAssignmentNumOperations = 0
+        self.allAssignments = []
+        self.allOptimalAssignments = []
+        self.exact = False
+
+    def solve(self, constructor, csp = None, max_expansions = 100000):
+        """
+        Finds the best schedule of |constructor|.
+
+        @param constructor: The SchedulingCSPConstructor of the schedule, for
+            the costs, durations, travel times and totals.
+        @param csp: The CSP of constructor.get_basic_csp(), for the weights
+            and to check the schedule found. Built if not given.
+        @param max_expansions: The forward search gives up after expanding
+            this many partial schedules and keeps the best complete one it
+            has made, if any.
+
+        exact is set when the search ran to the end and the CSP gives the
+        schedule the weight the DP computed, i.e. it has no factors beyond
+        the ones of get_basic_csp(). optimalWeight is always the CSP weight.
+        """
+        if csp is None:
+            csp = constructor.get_basic_csp()
+        self.csp = csp
+        self.reset_results()
+
+        print "starting chain DP"
+        self.prepare(constructor)
+        self.backward()
+        weight, assignment, finished = self.search(max_expansions)
+        print "ending chain DP"
+        if assignment is None:
+            # proven infeasible if the search ran out of schedules
+            self.exact = finished
+            print "No solution was found."
+            return
+
+        self.optimalAssignment = assignment
+        self.optimalWeight = self.csp.get_assignment_weight(assignment)
+        self.numAssignments = self.numOptimalAssignments = 1
+        self.firstAssignmentNumOperations = self.numOperations
+        self.allAssignments = [assignment]
+        self.allOptimalAssignments = [assignment]
+        self.exact = finished and abs(self.optimalWeight - weight) <= 1e-9 * weight
+        print "Found %s schedule with weight %f in %d operations" % \
+            ("an optimal" if self.exact else "a", self.optimalWeight, self.numOperations)
+
+    def prepare(self, constructor):
+        """
+        Tabulates the slots, weights, costs and travel times in units.
+        """
+        csp = self.csp
+        unit = self.unit
+        numSlots = constructor.num_slots
+        self.first, self.last = 0, numSlots - 1
+        # activity slots, travel slot i + 1 follows activity slot i
+        self.slots = range(2, numSlots - 1, 2)
+        self.activities = list(csp.values[self.slots[0]])
+        for slot in self.slots:
+            if list(csp.values[slot]) != self.activities:
+                raise Exception("ChainDPSolver needs the same domain in every activity slot")
+        self.starts = list(csp.values[self.first])
+        self.ends = list(csp.values[self.last])
+
+        activities = self.activities
+        self.weights = [np.array([csp.get_unary_weight(slot, a) for a in activities]) for slot in self.slots]
+        self.startWeights = np.array([csp.get_unary_weight(self.first, h) for h in self.starts])
+        self.endWeights = np.array([csp.get_unary_weight(self.last, h) for h in self.ends])
+        self.cost = np.array([constructor.get_activity_cost(a) // unit for a in activities])
+        self.duration = np.array([constructor.get_activity_time(a) // unit for a in activities])
+        self.food = np.array([1 if constructor.is_food(a) else 0 for a in activities])
+        self.maxBudget = constructor.profile.budget // unit
+        self.maxTime = constructor.profile.total_time // unit
+        self.meals = constructor.num_meals if constructor.profile.want_food else 0
+
+        # travel[i] is the travel time in units over travel slot i from each
+        # value of slot i - 1 to each value of slot i + 1, and
+        # travelWeights[i] the weight of that travel time (0 if it is not in
+        # the domain of slot i)
+        self.travel = {}
+        self.travelWeights = {}
+        for i in range(1, numSlots, 2):
+            sources = self.starts if i - 1 == self.first else activities
+            destinations = self.ends if i + 1 == self.last else activities
+            travel = constructor.get_travel_durations(sources, destinations) // unit
+            weightByTravel = np.zeros(travel.max() + 1)
+            for value in csp.values[i]:
+                if value % unit == 0 and value // unit < len(weightByTravel):
+                    weightByTravel[value // unit] = csp.get_unary_weight(i, value)
+            self.travel[i] = travel
+            self.travelWeights[i] = weightByTravel[travel]
+
+    def shift(self, table, budget, time, meals):
+        """
+        Returns |table| (budget x time x meals) moved back by the given
+        amounts: result[b, t, m] = table[b + budget, t + time, m + meals],
+        0 past the end.
+        """
+        result = np.zeros(table.shape)
+        B, T, M = table.shape
+        if budget < B and time < T and meals < M:
+            result[:B - budget, :T - time, :M - meals] = table[budget:, time:, meals:]
+        return result
+
+    def backward(self):
+        """
+        The backward pass: bounds[j][a, b, t, m] is the best weight the slots
+        after activity slot j (and the way home) can add when slot j holds
+        activity a with b budget and t time units used and m meals taken,
+        allowing any activity but a right after it.
+        """
+        numActivities = len(self.activities)
+        shape = (numActivities, self.maxBudget + 1, self.maxTime + 1, self.meals + 1)
+        n = len(self.slots)
+        self.bounds = [None] * n
+
+        # the way home: the time left has to cover it and all the meals
+        # must have been taken
+        i = self.last - 1
+        bound = np.zeros(shape)
+        times = np.arange(self.maxTime + 1)
+        for h in range(len(self.ends)):
+            weights = self.endWeights[h] * self.travelWeights[i][:, h]
+            fits = times[None, :] + self.travel[i][:, h][:, None] <= self.maxTime
+            bound[:, :, :, self.meals] = np.maximum(bound[:, :, :, self.meals], (weights[:, None] * fits)[:, None, :])
+        self.bounds[n - 1] = bound
+
+        for j in range(n - 2, -1, -1):
+            i = self.slots[j] + 1
+            following = self.bounds[j + 1]
+            weights = self.weights[j + 1]
+            # reached[c] is the weight of taking activity c next, by budget,
+            # time and meals before it (its travel time not counted)
+            reached = np.zeros(shape)
+            for c in range(numActivities):
+                if weights[c] > 0:
+                    reached[c] = weights[c] * self.shift(following[c], self.cost[c], self.duration[c], self.food[c])
+            bound = np.zeros(shape)
+            travel = self.travel[i]
+            for g in np.unique(travel):
+                # the destinations |g| units away, moved back by the travel
+                arrived = np.zeros(shape)
+                if g < shape[2]:
+                    arrived[:, :, :shape[2] - g, :] = reached[:, :, g:, :]
+                for a in range(numActivities):
+                    destinations = np.flatnonzero((travel[a] == g) & (self.travelWeights[i][a] > 0))
+                    destinations = destinations[destinations != a]
+                    if len(destinations) == 0: continue
+                    best = arrived[destinations].max(axis=0) * self.travelWeights[i][a, destinations[0]]
+                    np.maximum(bound[a], best, bound[a])
+            self.bounds[j] = bound
+
+    def extend(self, j, travel, travelWeights, weight, budget, time, meals, used):
+        """
+        The ways to fill activity slot j of a partial schedule of |weight|
+        and state (|budget|, |time|, |meals|), |travel| and |travelWeights|
+        being the rows of the travel slot before it for the activity it ends
+        with. Returns the arrays of the activities not in |used| with a
+        nonzero bound, their weights, budgets, times, meals and bounds.
+        """
+        budgets = budget + self.cost
+        times = time + travel + self.duration
+        mealCounts = meals + self.food
+        weights = weight * travelWeights * self.weights[j]
+        ok = (budgets <= self.maxBudget) & (times <= self.maxTime) & (mealCounts <= self.meals) & (weights > 0)
+        ok[list(used)] = False
+        activities = np.flatnonzero(ok)
+        budgets, times, mealCounts = budgets[activities], times[activities], mealCounts[activities]
+        weights = weights[activities]
+        bounds = weights * self.bounds[j][activities, budgets, times, mealCounts]
+        keep = bounds > 0
+        return activities[keep], weights[keep], budgets[keep], times[keep], mealCounts[keep], bounds[keep]
+
+    def search(self, max_expansions):
+        """
+        Best-first search forward over the partial schedules without repeated
+        activities, by their weight times the bound of their state. A path
+        holds the index of the start, the activities and the end. Returns
+        (weight, assignment, finished): the first complete schedule taken off
+        the queue, which is optimal, and True; or after max_expansions the
+        best complete schedule made so far and False; or (0, None, True)
+        when there is none at all.
+        """
+        n = len(self.slots)
+        queue = [] # heap of (-bound, order, weight, j, activity, budget, time, meals, path)
+        order = 0
+        best = (0, None)
+
+        i = self.first + 1
+        for h in range(len(self.starts)):
+            children = self.extend(0, self.travel[i][h], self.travelWeights[i][h], self.startWeights[h], 0, 0, 0, ())
+            for a, weight, b, t, m, bound in zip(*children):
+                order += 1
+                heapq.heappush(queue, (-bound, order, weight, 0, a, b, t, m, (h, a)))
+
+        while queue:
+            negBound, _, weight, j, a, b, t, m, path = heapq.heappop(queue)
+            if j == n:
+                return weight, self.get_assignment(path), True
+            if self.numOperations >= max_expansions:
+                return best[0], self.get_assignment(best[1]) if best[1] else None, False
+            self.numOperations += 1
+            if j == n - 1:
+                # head home, with every meal taken and in time
+                i = self.last - 1
+                if m != self.meals: continue
+                for h in range(len(self.ends)):
+                    if t + self.travel[i][a, h] > self.maxTime: continue
+                    complete = weight * self.travelWeights[i][a, h] * self.endWeights[h]
+                    if complete <= 0: continue
+                    order += 1
+                    heapq.heappush(queue, (-complete, order, complete, n, h, b, t, m, path + (h,)))
+                    if complete > best[0]: best = (complete, path + (h,))
+                continue
+            i = self.slots[j] + 1
+            children = self.extend(j + 1, self.travel[i][a], self.travelWeights[i][a], weight, b, t, m, path[1:])
+            for a2, weight2, b2, t2, m2, bound in zip(*children):
+                order += 1
+                heapq.heappush(queue, (-bound, order, weight2, j + 1, a2, b2, t2, m2, path + (a2,)))
+        return 0, None, True
+
+    def get_assignment(self, path):
+        """
+        Returns the CSP assignment of a complete path, travel slots included.
+        """
+        values = [self.starts[path[0]]] + [self.activities[a] for a in path[1:-1]] + [self.ends[path[-1]]]
+        assignment = {}
+        for k, value in enumerate(values):
+            assignment[2 * k] = value
+            if k + 1 < len(values):
+                assignment[2 * k + 1] = int(self.travel[2 * k + 1][path[k], path[k + 1]]) * self.unit
+        return assignment
@@ -8,17 +8,23 @@ def test_beamsearch(k):
 
   if alg.allAssignments:
     print "printing k=%d assignments found" % k
-    return util.print_all_scheduling_solutions_beam(alg.allAssignments, profile, activities)
+    return util.print_all_scheduling_solutions_beam(alg.allAssignments, profile, activities, travelMatrix)
   else:
     print "no solution found"
   return alg.allAssignments
 
+# AC-3 proves a profile that doesn't fit the catalog infeasible in about a
+# minute where plain MCV search ran for more than 9; the budget stops it anyway
+timeBudget = 120 # seconds
+
 def test_backtrack(max_num_assignments):
   alg = submission.BacktrackingSearch()
-  alg.solve(csp, mcv = True, ac3 = False, max_num_assignments = max_num_assignments)
+  alg.solve(csp, mcv = True, ac3 = True, max_num_assignments = max_num_assignments, time_budget = timeBudget)
+  if alg.timedOut:
+    print "search stopped after %d seconds, showing the best found so far" % timeBudget
   if alg.allOptimalAssignments:
     print "all optimal assignments"
-    return util.print_all_scheduling_solutions(alg.allOptimalAssignments, profile, activities)
+    return util.print_all_scheduling_solutions(alg.allOptimalAssignments, profile, activities, travelMatrix)
   else:
     print "no solution found"
   return alg.allOptimalAssignments
@@ -29,7 +35,7 @@ def test_icm(max_iterations, initial_assignment, gibbs_sampling):
     initial_assignment = initial_assignment, gibbs_sampling = gibbs_sampling)
   if alg.optimalAssignment:
     print "printing solution"
-    return util.print_scheduling_solution(alg.optimalAssignment, profile, activities)
+    return util.print_scheduling_solution(alg.optimalAssignment, profile, activities, travelMatrix)
   else:
     print "no solution found"
 
@@ -44,7 +50,9 @@ profile.print_info()
 genreToPath = {'thrill':'../activities_100.json','food':'../restaurants_100.json'}
 # genreToPath = {'thrill':'../activities_short.json','food':'../restaurants_short.json'}
 activities = util.ActivityCollection(profile, genreToPath).activities
-cspConstructor = submission.SchedulingCSPConstructor(activities, profile)
+# one set of travel times for the solver and for scoring its schedules
+travelMatrix = util.TravelMatrix(activities, submission.time_per_mile)
+cspConstructor = submission.SchedulingCSPConstructor(activities, profile, travelMatrix)
 csp = cspConstructor.get_basic_csp()
 
 
@@ -53,8 +61,8 @@ csp = cspConstructor.get_basic_csp()
 for i in range(0,100):
   startTime = datetime.now()
   alg = submission.BacktrackingSearch()
-  alg.solve(csp, mcv = True, ac3 = False, max_num_assignments = 10)
-  backtrackStart = util.print_all_scheduling_solutions(alg.allOptimalAssignments, profile, activities)
+  alg.solve(csp, mcv = True, ac3 = True, max_num_assignments = 10, time_budget = timeBudget)
+  backtrackStart = util.print_all_scheduling_solutions(alg.allOptimalAssignments, profile, activities, travelMatrix)
   score = test_icm(100,  alg.optimalAssignment, True)
   runTime = datetime.now() - startTime
   with open("gibbs_runtimes.txt", 'a') as file:
@@ -13,7 +13,9 @@ profile.print_info()
 genreToPath = {'thrill':'../all.json','food':'../restaurants.json'}
 # genreToPath = {'thrill':'../activities_short.json','food':'../restaurants_short.json'}
 activities = util.ActivityCollection(profile, genreToPath).activities
-cspConstructor = submission.SchedulingCSPConstructor(activities, profile)
+# one set of travel times for the solver and for scoring its schedules
+travelMatrix = util.TravelMatrix(activities, submission.time_per_mile)
+cspConstructor = submission.SchedulingCSPConstructor(activities, profile, travelMatrix)
 csp = cspConstructor.get_basic_csp()
 # cspConstructor.add_all_additional_constraints(csp)
 alg = submission.BeamSearch()
@@ -22,7 +24,7 @@ alg.solve(csp, mcv = True, ac3 = False, k = k)
 
 if alg.allAssignments:
   print "printing k=%d assignments found" % k
-  util.print_all_scheduling_solutions_beam(alg.allAssignments, profile, activities)
+  util.print_all_scheduling_solutions_beam(alg.allAssignments, profile, activities, travelMatrix)
 else:
   print "no solution found"
 
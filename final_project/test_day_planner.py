@@ -12,14 +12,21 @@ profile.print_info()
 # genreToPath = {'thrill':'../activities_100.json','food':'../restaurants_100.json'}
 genreToPath = {'thrill':'../activities_100.json','food':'../restaurants_100.json'}
 activities = util.ActivityCollection(profile, genreToPath).activities
-cspConstructor = submission.SchedulingCSPConstructor(activities, profile)
+# one set of travel times for the solver and for scoring its schedules
+travelMatrix = util.TravelMatrix(activities, submission.time_per_mile)
+cspConstructor = submission.SchedulingCSPConstructor(activities, profile, travelMatrix)
 csp = cspConstructor.get_basic_csp()
 # cspConstructor.add_all_additional_constraints(csp)
 alg = submission.BacktrackingSearch()
-alg.solve(csp, mcv = True, ac3 = False, max_num_assignments = 100)
+# AC-3 proves a profile that doesn't fit the catalog infeasible in about a
+# minute where plain MCV search ran for more than 9; the budget stops it anyway
+timeBudget = 120 # seconds
+alg.solve(csp, mcv = True, ac3 = True, max_num_assignments = 100, time_budget = timeBudget)
+if alg.timedOut:
+  print "search stopped after %d seconds, showing the best found so far" % timeBudget
 if alg.allOptimalAssignments:
   print "all optimal assignments"
-  util.print_all_scheduling_solutions(alg.allOptimalAssignments, profile, activities)
+  util.print_all_scheduling_solutions(alg.allOptimalAssignments, profile, activities, travelMatrix)
 else:
   print "no solution found"
 
@@ -12,13 +12,15 @@ genre = 'thrill'
 genreToPath = {genre:'../activities_100.json','food':'../restaurants_100.json'}
 # genreToPath = {'thrill':'../activities_short.json','food':'../restaurants_short.json'}
 activities = util.ActivityCollection(profile, genreToPath).activities
-cspConstructor = submission.SchedulingCSPConstructor(activities, profile)
+# one set of travel times for the solver and for scoring its schedules
+travelMatrix = util.TravelMatrix(activities, submission.time_per_mile)
+cspConstructor = submission.SchedulingCSPConstructor(activities, profile, travelMatrix)
 csp = cspConstructor.get_basic_csp()
 # cspConstructor.add_all_additional_constraints(csp)
 alg = submission.ICRSearch()
 alg.solve(csp, num_assignments = 10, activities = activities, genre = genre)
 if alg.allAssignments:
   print "printing k=%d assignments found" % 10
-  util.print_all_scheduling_solutions(alg.allAssignments, profile, activities)
+  util.print_all_scheduling_solutions(alg.allAssignments, profile, activities, travelMatrix)
 else:
   print "no solution found"